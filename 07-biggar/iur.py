@@ -81,7 +81,7 @@ def iur_encode(chrdata, *, report=False):
         maxsofar = max(t, maxsofar)
 
     if report:
-        pbunique = b''.join(pb16.pb16(b''.join(utiles)))
+        pbunique = pb16.encode(b''.join(utiles))
         sameas1ago = [l for l, r in zip(tilemap, tilemap[1:]) if l == r]
         sameas2ago = [l for l, r in zip(tilemap, tilemap[2:]) if l == r]
         sameaslplus1 = [l for l, r in zip(tilemap, tilemap[1:]) if l + 1 == r]
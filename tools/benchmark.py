@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the tile codecs used by Libbet's build tools
+
+Copyright 2026 Damian Yerrick
+
+This software is provided 'as-is', without any express or implied
+warranty. In no event will the authors be held liable for any damages
+arising from the use of this software.
+
+Permission is granted to anyone to use this software for any purpose,
+including commercial applications, and to alter it and redistribute it
+freely, subject to the following restrictions:
+
+1. The origin of this software must not be misrepresented; you must not
+   claim that you wrote the original software. If you use this software
+   in a product, an acknowledgment in the product documentation would be
+   appreciated but is not required.
+2. Altered source versions must be plainly marked as such, and must not be
+   misrepresented as being the original software.
+3. This notice may not be removed or altered from any source distribution.
+
+Converts each PNG image to Game Boy CHR data and runs these codecs
+over it:
+
+pb16 -- the reference pb16.pb16() generator
+encode -- pb16.encode() (including the C kernel if built)
+iur -- iur.iur_encode() on the tilemap of unique tiles
+border -- makeborder's path: Super NES CHR, flipuniq(), and PB16
+
+For each it reports throughput in MB/s of input, packets (8 bytes of
+input) per second, peak memory allocated as measured by tracemalloc,
+and compressed size as a fraction of input size.  Write the results
+as JSON with -o and compare them to an earlier run with --compare.
+"""
+import os
+import sys
+import argparse
+import glob
+import json
+import time
+import tracemalloc
+import subprocess
+from PIL import Image
+
+toolsdir = os.path.dirname(os.path.abspath(__file__))
+topdir = os.path.dirname(toolsdir)
+sys.path.append(os.path.join(topdir, "07-biggar"))
+import pb16
+import iur
+import makeborder
+from pilbmp2nes import pilbmp2chr, compileTilePlanar
+
+default_folders = ["tilesets", "07-biggar"]
+
+gbformat = compileTilePlanar("0,1")
+
+def load_image(filename):
+    """Open an image and reduce it to at most 4 colors if needed."""
+    im = Image.open(filename)
+    if im.mode != 'P':
+        im = im.convert("RGB").quantize(4)
+    return im
+
+def run_pb16(chrdata):
+    return b"".join(pb16.pb16(chrdata))
+
+def run_encode(chrdata):
+    return pb16.encode(chrdata)
+
+def run_iur(tiles):
+    return iur.iur_encode(tiles)
+
+def run_border(im):
+    tiles = pilbmp2chr(im, formatTile=makeborder.snesformat)
+    utiles, tilemap = makeborder.flipuniq(tiles)
+    return pb16.encode(b"".join(utiles))
+
+def time_best(fn, arg, repeat):
+    """Return (result, fastest time in seconds) of repeat calls to fn(arg)."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    return result, best
+
+def measure_peak(fn, arg):
+    """Return the peak bytes allocated by fn(arg) according to tracemalloc."""
+    tracemalloc.start()
+    try:
+        fn(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_image(filename, repeat=3):
+    """Run all codecs on one image and return a list of result dicts."""
+    im = load_image(filename)
+    im.load()
+    tiles = pilbmp2chr(im, formatTile=gbformat)
+    chrdata = b"".join(tiles)
+    snesim = im.crop((0, 0, 256, im.size[1])) if im.size[0] > 256 else im
+    snestiles = -(-snesim.size[0] // 8) * -(-snesim.size[1] // 8)
+
+    # (codec name, function, argument, input size in bytes)
+    jobs = [
+        ("pb16", run_pb16, chrdata, len(chrdata)),
+        ("encode", run_encode, chrdata, len(chrdata)),
+        ("border", run_border, snesim, snestiles * 32),
+    ]
+    # IUR codes map entries as bytes, so it needs 256 or fewer tiles.
+    # Count its input as one byte per map entry.
+    if len(set(tiles)) <= 256:
+        jobs.append(("iur", run_iur, tiles, len(tiles)))
+    results = []
+    for codec, fn, arg, insize in jobs:
+        out, seconds = time_best(fn, arg, repeat)
+        seconds = max(seconds, 1e-9)
+        results.append({
+            "file": os.path.relpath(filename, topdir).replace(os.sep, "/"),
+            "codec": codec,
+            "in_bytes": insize,
+            "out_bytes": len(out),
+            "ratio": len(out) / insize if insize else 1.0,
+            "seconds": seconds,
+            "mb_per_s": insize / seconds / 1e6,
+            "packets_per_s": -(-insize // 8) / seconds,
+            "peak_bytes": measure_peak(fn, arg),
+        })
+    return results
+
+def get_commit():
+    """Return the Git commit ID of the tree, or None if unknown."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=topdir,
+            stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, oldresults):
+    """Print throughput of each result relative to an earlier run."""
+    old = {(r["file"], r["codec"]): r for r in oldresults}
+    for r in results:
+        o = old.get((r["file"], r["codec"]))
+        if not o: continue
+        print("%-40s %-6s speed %5.2fx  size %5.2fx"
+              % (r["file"], r["codec"], r["mb_per_s"] / o["mb_per_s"],
+                 r["out_bytes"] / max(o["out_bytes"], 1)))
+
+def parse_argv(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("images", nargs="*",
+                   help="PNG files to test (default: all in %s)"
+                   % " and ".join(default_folders))
+    p.add_argument("-o", "--output",
+                   help="write results as JSON to this file")
+    p.add_argument("--compare",
+                   help="compare results to JSON from an earlier run")
+    p.add_argument("-r", "--repeat", type=int, default=3,
+                   help="time the fastest of this many runs (default: 3)")
+    return p.parse_args(argv[1:])
+
+def main(argv=None):
+    args = parse_argv(argv or sys.argv)
+    filenames = args.images or sorted(
+        filename for folder in default_folders
+        for filename in glob.glob(os.path.join(topdir, folder, "*.png"))
+    )
+    results = []
+    for filename in filenames:
+        for r in bench_image(filename, args.repeat):
+            print("%-40s %-6s %8.3f MB/s %10.0f packets/s %9d peak %5.3f ratio"
+                  % (r["file"], r["codec"], r["mb_per_s"],
+                     r["packets_per_s"], r["peak_bytes"], r["ratio"]))
+            results.append(r)
+
+    if args.output:
+        doc = {
+            "commit": get_commit(),
+            "python": sys.version.split()[0],
+            "accel": pb16.encode_packets_c is not None,
+            "results": results,
+        }
+        with open(args.output, "w") as outfp:
+            json.dump(doc, outfp, indent=1)
+    if args.compare:
+        with open(args.compare, "r") as infp:
+            compare(results, json.load(infp)["results"])
+
+if __name__=='__main__':
+    main()
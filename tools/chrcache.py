@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache for image conversion results
+Copyright 2026 Damian Yerrick
+[License: zlib]
+
+Converting the same pixels with the same options always produces
+the same bytes, so the converters store their results in files
+named by a hash of everything that went into them.  A later run
+that hashes to the same key reads the result instead of converting
+again.  pilbmp2chr() caches at the level of whatever image it is
+given, so extractcels, which converts one strip at a time, redoes
+only the strips whose pixels changed.
+
+Set environment variable CHRCACHE_DIR to a folder to turn on the
+cache, and CHRCACHE_MAX to its size limit in bytes (default 64 MiB).
+When the cache grows past the limit, the least recently used
+results are removed at exit.
+"""
+import os
+import sys
+import hashlib
+import tempfile
+import atexit
+import argparse
+from functools import lru_cache
+
+# Change this when the cache's own layout or key scheme changes.
+# Converters also put source_digest(__file__) in their keys, so that
+# editing a converter discards the results it cached before.
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 64 << 20
+
+def make_key(*parts):
+    """Hash a tuple of bytes-like objects, strings, and numbers into a key."""
+    h = hashlib.sha256()
+    for part in (CACHE_VERSION,) + parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            h.update(b"b%d:" % len(part))
+            h.update(part)
+        else:
+            part = repr(part).encode("utf-8")
+            h.update(b"r%d:" % len(part))
+            h.update(part)
+    return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def source_digest(filename):
+    """Hash the source code of a converter module, given its __file__."""
+    with open(filename, "rb") as infp:
+        return hashlib.sha256(infp.read()).hexdigest()
+
+def image_digest(im, palette=False):
+    """Hash a Pillow image's mode, size, pixels, and optionally palette."""
+    h = hashlib.sha256()
+    h.update(("%s %d %d\n" % ((im.mode,) + im.size)).encode("ascii"))
+    h.update(im.tobytes())
+    if palette and im.mode == 'P':
+        h.update(bytes(im.getpalette() or b""))
+    return h.hexdigest()
+
+class ChrCache(object):
+    """A folder of conversion results keyed by make_key() hashes."""
+    def __init__(self, folder, max_bytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key[2:])
+
+    def get(self, key):
+        """Return the bytes stored for key, or None if not cached."""
+        filename = self.path(key)
+        try:
+            with open(filename, "rb") as infp:
+                data = infp.read()
+        except OSError:
+            return None
+        # Mark as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Store bytes for key, replacing any previous result atomically."""
+        filename = self.path(key)
+        folder = os.path.dirname(filename)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as outfp:
+                outfp.write(data)
+            os.replace(tmpname, filename)
+        except OSError as e:
+            # A cache that can't be written only costs speed
+            print("chrcache: %s" % e, file=sys.stderr)
+
+    def entries(self):
+        """List (last use time, size, filename) of all cached results."""
+        out = []
+        try:
+            subfolders = os.listdir(self.folder)
+        except OSError:
+            return out
+        for sub in subfolders:
+            subpath = os.path.join(self.folder, sub)
+            if not os.path.isdir(subpath): continue
+            for name in os.listdir(subpath):
+                filename = os.path.join(subpath, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, filename))
+        return out
+
+    def evict(self):
+        """Remove least recently used results until under max_bytes."""
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_bytes: break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+_default_cache = None
+
+def get_default():
+    """Return the ChrCache set by CHRCACHE_DIR, or None if not set."""
+    global _default_cache
+    if _default_cache is None:
+        folder = os.environ.get("CHRCACHE_DIR")
+        if not folder:
+            _default_cache = False
+        else:
+            max_bytes = int(os.environ.get("CHRCACHE_MAX")
+                            or DEFAULT_MAX_BYTES)
+            _default_cache = ChrCache(folder, max_bytes)
+            atexit.register(_default_cache.evict)
+    return _default_cache or None
+
+def parse_argv(argv):
+    p = argparse.ArgumentParser(description="Show or trim a conversion cache.")
+    p.add_argument("folder", nargs="?", default=os.environ.get("CHRCACHE_DIR"),
+                   help="cache folder (default: $CHRCACHE_DIR)")
+    p.add_argument("--max-bytes", type=int, default=None,
+                   help="evict least recently used results down to this size")
+    args = p.parse_args(argv[1:])
+    if not args.folder:
+        p.error("no cache folder given and CHRCACHE_DIR not set")
+    return args
+
+def main(argv=None):
+    args = parse_argv(argv or sys.argv)
+    cache = ChrCache(args.folder)
+    if args.max_bytes is not None:
+        cache.max_bytes = args.max_bytes
+        cache.evict()
+    entries = cache.entries()
+    print("%s: %d results, %d bytes"
+          % (args.folder, len(entries), sum(e[1] for e in entries)))
+
+if __name__=='__main__':
+    main()
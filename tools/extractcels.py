@@ -82,6 +82,7 @@ from PIL import Image, ImageDraw
 import os, sys, argparse, re
 from collections import OrderedDict
 import pilbmp2nes
+import chrcache
 
 # Parsing the strips file
 
@@ -321,9 +322,24 @@ Reference: https://stackoverflow.com/a/29438149/2738262
 def apply_global_palette(im, doc):
     if not doc.global_palette:
         doc.calc_global_palette()
+    cache = chrcache.get_default()
+    if cache:
+        key = chrcache.make_key("apply_global_palette",
+                                chrcache.source_digest(__file__),
+                                Image.__version__,
+                                chrcache.image_digest(im, palette=True),
+                                doc.global_palette)
+        data = cache.get(key)
+        if data is not None:
+            out = Image.frombytes("P", im.size, data)
+            out.putpalette(doc.global_palette)
+            return out
     palim = Image.new("P", (16, 16))
     palim.putpalette(doc.global_palette)
-    return quantizetopalette(im.convert("RGB"), palim)
+    out = quantizetopalette(im.convert("RGB"), palim)
+    if cache:
+        cache.put(key, out.tobytes())
+    return out
 
 TILE_W = 8
 TILE_PLANEMAP = "0,1"
@@ -343,7 +359,7 @@ def read_strip(im, strip, g2l, hotspot, tile_ht, verbose=False):
     padded.paste(cropped, (lpad, tpad))
 
     # Convert image to tiles
-    tilefmt = lambda x: pilbmp2nes.formatTilePlanar(x, TILE_PLANEMAP)
+    tilefmt = pilbmp2nes.compileTilePlanar(TILE_PLANEMAP)
     striptiles = pilbmp2nes.pilbmp2chr(padded, TILE_W, tile_ht, tilefmt)
 
     # Join top and bottom halves of 8x16-pixel tiles
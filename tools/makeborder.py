@@ -31,10 +31,9 @@ commontoolspath = os.path.normpath(os.path.join(
     os.path.dirname(sys.argv[0]), "..", "..", "common", "tools"
 ))
 if os.path.isdir(commontoolspath): sys.path.append(commontoolspath)
-from pilbmp2nes import pilbmp2chr, formatTilePlanar
+from pilbmp2nes import pilbmp2chr, compileTilePlanar
 
-def snesformat(tile):
-    return formatTilePlanar(tile, "0,1;2,3")
+snesformat = compileTilePlanar("0,1;2,3")
 
 def get_bitreverse():
     """Get a lookup table for horizontal flipping."""
@@ -105,7 +104,7 @@ def main(argv=None):
     tiles = pilbmp2chr(im, formatTile=snesformat)
     utiles, tilemap = flipuniq(tiles)
     assert len(utiles) <= 64
-    pbtiles = b"".join(pb16.pb16(b"".join(utiles)))
+    pbtiles = pb16.encode(b"".join(utiles))
     tmrows = [bytes(tilemap[i:i + 32]) for i in range(0, len(tilemap), 32)]
 
     # Encode the tilemap based on which compression options
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+PackBits encoder and decoder
+Copyright 2026 Damian Yerrick
+[License: zlib]
+
+PackBits is the byte-oriented run-length encoding from the Apple
+Macintosh.  Each packet starts with a header byte n:
+
+- 0 to 127: n + 1 literal bytes follow
+- 129 to 255: the next byte repeats 257 - n times (2 to 128)
+- 128: no operation
+
+This encoder codes runs of 3 or more bytes as runs, as a run of 2
+costs as much as a literal pair and breaks up a literal packet.
+"""
+import re
+import sys
+import argparse
+
+# A byte followed by 2 to 127 copies of itself
+run_re = re.compile(rb"(.)\1{2,127}", re.DOTALL)
+
+def emit_literals(out, literals):
+    """Append literal packets of up to 128 bytes each to out."""
+    for i in range(0, len(literals), 128):
+        chunk = literals[i:i + 128]
+        out.append(len(chunk) - 1)
+        out.extend(chunk)
+
+class Encoder(object):
+    """Incremental PackBits encoder.
+
+Feed it blocks of any size with encode(), then call flush() once.
+Bytes that might join a run or literal packet in the next block are
+held back, so the output matches encoding the whole stream at once.
+"""
+    def __init__(self):
+        self.pending = b""
+
+    def encode(self, data, final=False):
+        """Compress more data, returning all packets that are complete."""
+        data = self.pending + bytes(data)
+        out = bytearray()
+
+        # Runs touching the end may continue in the next block, as may
+        # a run that starts in the last 2 bytes
+        stop = len(data) if final else max(len(data) - 2, 0)
+        litstart = 0
+        for m in run_re.finditer(data):
+            if not final and m.end() == len(data):
+                stop = min(stop, m.start())
+                break
+            emit_literals(out, data[litstart:m.start()])
+            out.append(257 - len(m.group()))
+            out.append(data[m.start()])
+            litstart = m.end()
+        stop = max(stop, litstart)
+
+        # Emit only whole literal packets until the end of the stream
+        if not final:
+            stop = litstart + (stop - litstart) // 128 * 128
+        emit_literals(out, data[litstart:stop])
+        self.pending = data[stop:]
+        return bytes(out)
+
+    def flush(self):
+        """Compress whatever remains at the end of the stream."""
+        return self.encode(b"", final=True)
+
+def encode(data):
+    """Compress a bytes-like object with PackBits."""
+    return Encoder().encode(data, final=True)
+
+def decode(data):
+    """Decompress PackBits data."""
+    data = bytes(data)
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        n = data[pos]
+        pos += 1
+        if n < 128:
+            if pos + n + 1 > len(data):
+                raise ValueError("PackBits data ends in the middle of a packet")
+            out.extend(data[pos:pos + n + 1])
+            pos += n + 1
+        elif n > 128:
+            if pos >= len(data):
+                raise ValueError("PackBits data ends in the middle of a packet")
+            out.extend(data[pos:pos + 1] * (257 - n))
+            pos += 1
+    return bytes(out)
+
+def parse_argv(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("infile")
+    p.add_argument("outfile")
+    p.add_argument("-d", "--decompress", action="store_true",
+                   help="decompress PackBits data instead of compressing")
+    return p.parse_args(argv[1:])
+
+def main(argv=None):
+    args = parse_argv(argv or sys.argv)
+    with open(args.infile, "rb") as infp:
+        data = infp.read()
+    with open(args.outfile, "wb") as outfp:
+        outfp.write(decode(data) if args.decompress else encode(data))
+
+def test():
+    import random
+
+    s = b"ABCCCCCCDDEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEEE"
+    print(encode(s).hex())
+    assert decode(encode(s)) == s
+
+    # Streaming in blocks must match encoding at once
+    rng = random.Random(144)
+    for length in range(0, 600, 7):
+        for alphabet in (b"A", b"AB", bytes(range(256))):
+            s = bytes(rng.choice(alphabet) for i in range(length))
+            expected = encode(s)
+            assert decode(expected) == s, s.hex()
+            for block_size in (1, 2, 5, 130):
+                enc = Encoder()
+                out = [enc.encode(s[i:i + block_size])
+                       for i in range(0, len(s), block_size)]
+                out.append(enc.flush())
+                assert b"".join(out) == expected, (s.hex(), block_size)
+    print("streaming PackBits matches")
+
+if __name__=='__main__':
+    main()
+##    test()
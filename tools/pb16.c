@@ -0,0 +1,46 @@
+/*
+PB16 encoder kernel for pb16.py
+Copyright 2026 Damian Yerrick
+[License: zlib]
+
+Optional accelerator for pb16.encode_packets().  Build it with
+  cc -O2 -shared -fPIC -o tools/pb16accel.so tools/pb16.c
+and pb16.py loads it through ctypes.  Without it, pb16.py uses
+its pure Python path, which produces identical output.
+*/
+#include <stddef.h>
+
+/**
+ * Compresses whole 8-byte packets.
+ * @param src uncompressed data
+ * @param len length of src in bytes, a multiple of 8
+ * @param prev the 2 bytes before src (0, 0 at start of stream)
+ * @param dst output buffer of at least len + len / 8 bytes
+ * @return number of bytes written to dst
+ */
+size_t pb16_encode_packets(const unsigned char *src, size_t len,
+                           const unsigned char *prev, unsigned char *dst) {
+  unsigned char p0 = prev[0], p1 = prev[1];
+  unsigned char *out = dst;
+
+  for (; len >= 8; len -= 8) {
+    unsigned char *header = out++;
+    unsigned int bits = 0;
+    for (unsigned int i = 0; i < 8; i += 2) {
+      unsigned char b0 = *src++, b1 = *src++;
+      bits <<= 2;
+      if (b0 == p0) {
+        bits |= 2;
+      } else {
+        *out++ = p0 = b0;
+      }
+      if (b1 == p1) {
+        bits |= 1;
+      } else {
+        *out++ = p1 = b1;
+      }
+    }
+    *header = bits;
+  }
+  return out - dst;
+}
@@ -19,8 +19,13 @@ It's similar to the PB8 codec that I've used for NES CHR data,
 adapted to the interleaving of Game Boy and Super NES CHR data.
 """
 import itertools
+import operator
+import os
+import re
 import sys
 import argparse
+import hashlib
+import json
 
 def ichunk(data, count):
     """Turn an iterable into lists of a fixed length."""
@@ -51,26 +56,437 @@ def pb16(data):
                 prev[i % 2] = value
         yield packet
 
+# bytes.translate() tables that turn a column of repeat flags (0 or 1)
+# into that column's bit of the packet header
+_header_bits = [
+    bytes(0x80 >> i if v == 1 else 0 for v in range(256))
+    for i in range(8)
+]
+
+# Number of literal bytes that follow each possible packet header
+_literal_counts = bytes(8 - bin(v).count("1") for v in range(256))
+
+def pad_to_packet(data, prev=b"\0\0"):
+    """Pad a bytes-like object to a multiple of 8 bytes the same way pb16() does.
+
+A trailing odd byte is paired with the byte 2 before it (or from
+prev, the last 2 bytes of the stream before data), and the last
+2 bytes are repeated to fill out the packet.
+"""
+    data = bytes(data)
+    tail = len(data) % 8
+    if not tail: return data
+    if tail % 2:
+        data += (prev + data)[-2:-1]
+    return data + data[-2:] * ((8 - tail) // 2)
+
+def encode_packets_py(data, prev=b"\0\0"):
+    """Compress whole 8-byte packets following the 2 bytes prev."""
+    prev = bytes(prev) + data[:-2]
+    npackets = len(data) // 8
+
+    # Build all packet headers at once, one bit column at a time
+    headers = 0
+    for i, bittable in enumerate(_header_bits):
+        flags = bytes(map(operator.eq, data[i::8], prev[i::8]))
+        headers |= int.from_bytes(flags.translate(bittable), "big")
+    headers = headers.to_bytes(npackets, "big")
+    literals = bytes(itertools.compress(data, map(operator.ne, data, prev)))
+
+    # Interleave headers and literals into one preallocated buffer
+    out = bytearray(npackets + len(literals))
+    dst = src = 0
+    for header in headers:
+        nlits = _literal_counts[header]
+        out[dst] = header
+        out[dst + 1:dst + 1 + nlits] = literals[src:src + nlits]
+        dst += 1 + nlits
+        src += nlits
+    return bytes(out)
+
+# Optional C kernel built from pb16.c.  Set environment variable
+# PB16_NOACCEL to a nonempty value to use the Python path anyway.
+accel_names = ["pb16accel.so", "pb16accel.dll", "pb16accel.dylib"]
+
+def load_accel_lib(filename):
+    """Load the C encoder from a shared library, returning a function or None."""
+    try:
+        import ctypes
+        lib = ctypes.CDLL(filename)
+    except (ImportError, OSError):
+        return None
+    kernel = lib.pb16_encode_packets
+    kernel.restype = ctypes.c_size_t
+    kernel.argtypes = [
+        ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p, ctypes.c_char_p
+    ]
+
+    def encode_packets_c(data, prev=b"\0\0"):
+        """Compress whole 8-byte packets following the 2 bytes prev."""
+        data = bytes(data)
+        out = ctypes.create_string_buffer(len(data) + len(data) // 8)
+        outlen = kernel(data, len(data), bytes(prev), out)
+        return out.raw[:outlen]
+    return encode_packets_c
+
+def load_accel():
+    """Load the C encoder if built, returning a function or None."""
+    if os.environ.get("PB16_NOACCEL"): return None
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name in accel_names:
+        kernel = load_accel_lib(os.path.join(folder, name))
+        if kernel: return kernel
+    return None
+
+def build_accel(folder):
+    """Compile pb16.c into folder with $CC (default cc).
+
+Return the C encoder function, or None if it couldn't be built.
+"""
+    import subprocess
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pb16.c")
+    libname = os.path.join(folder, accel_names[0])
+    cmd = [os.environ.get("CC") or "cc", "-O2", "-std=c99", "-shared",
+           "-fPIC", "-o", libname, src]
+    try:
+        subprocess.check_call(cmd)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("pb16.py: couldn't build C kernel: %s" % e, file=sys.stderr)
+        return None
+    return load_accel_lib(libname)
+
+encode_packets_c = load_accel()
+encode_packets = encode_packets_c or encode_packets_py
+
+def encode(data):
+    """Compress a bytes-like object into PB16 packets.
+
+Produces the same bytes as b"".join(pb16(data)), but compares the
+whole buffer against itself shifted by 2 bytes at once instead of
+walking it a byte at a time.  Since a repeated byte equals the byte
+2 back, the repeat flags depend only on the input, not on state.
+"""
+    return encode_packets(pad_to_packet(memoryview(data).cast("B")))
+
+def decode(data):
+    """Decompress PB16 packets.
+
+The result is always a multiple of 8 bytes long, as the encoder
+pads the last packet.
+"""
+    dec = Decoder()
+    out = dec.decode(data)
+    dec.flush()
+    return out
+
+class Encoder(object):
+    """Incremental PB16 encoder.
+
+Feed it blocks of any size with encode(), then call flush() once to
+get the padded last packet.  Only the last 2 bytes and any partial
+packet are kept between calls.
+"""
+    def __init__(self):
+        self.prev = b"\0\0"
+        self.pending = b""
+
+    def encode(self, data):
+        """Compress more data, returning packets for all complete 8-byte groups."""
+        data = self.pending + bytes(data)
+        usable = len(data) - len(data) % 8
+        self.pending = data[usable:]
+        if not usable: return b""
+        out = encode_packets(data[:usable], self.prev)
+        self.prev = data[usable - 2:usable]
+        return out
+
+    def flush(self):
+        """Compress the partial packet at the end of the stream."""
+        data = pad_to_packet(self.pending, self.prev)
+        self.pending = b""
+        return self.encode(data)
+
+class Decoder(object):
+    """Incremental PB16 decoder.
+
+Feed it blocks of any size with decode().  A packet split across
+blocks is held until the rest arrives.
+"""
+    def __init__(self):
+        self.prev = bytearray(2)
+        self.pending = b""
+
+    def decode(self, data):
+        """Decompress more data, returning the bytes of all complete packets."""
+        data = self.pending + bytes(data)
+        prev = self.prev
+        out = bytearray()
+        pos = 0
+        while pos < len(data):
+            header = data[pos]
+            end = pos + 1 + _literal_counts[header]
+            if end > len(data): break
+            pos += 1
+            for i in range(8):
+                if not (header << i) & 0x80:
+                    prev[i % 2] = data[pos]
+                    pos += 1
+                out.append(prev[i % 2])
+        self.pending = data[pos:]
+        return bytes(out)
+
+    def flush(self):
+        """Check that the stream did not end in the middle of a packet."""
+        if self.pending:
+            raise ValueError("PB16 data ends in the middle of a packet")
+        return b""
+
+BLOCK_SIZE = 65536
+
+def transcode_file(process, flush, infp, outfp, block_size=BLOCK_SIZE):
+    """Pass blocks from one binary file object through process() to another."""
+    while True:
+        block = infp.read(block_size)
+        if not block: break
+        outfp.write(process(block))
+    outfp.write(flush())
+
+def encode_file(infp, outfp, block_size=BLOCK_SIZE):
+    """Compress one binary file object to another in constant memory."""
+    enc = Encoder()
+    transcode_file(enc.encode, enc.flush, infp, outfp, block_size)
+
+def decode_file(infp, outfp, block_size=BLOCK_SIZE):
+    """Decompress one binary file object to another in constant memory."""
+    dec = Decoder()
+    transcode_file(dec.decode, dec.flush, infp, outfp, block_size)
+
+def convert_path(infile, outfile, decompress=False):
+    """Compress or decompress one file to another by name (- for stdio)."""
+    convert = decode_file if decompress else encode_file
+    infp = (sys.stdin.buffer if infile == '-'
+            else open(infile, "rb"))
+    try:
+        outfp = (sys.stdout.buffer if outfile == '-'
+                 else open(outfile, "wb"))
+        try:
+            convert(infp, outfp)
+        finally:
+            if outfp is not sys.stdout.buffer: outfp.close()
+    finally:
+        if infp is not sys.stdin.buffer: infp.close()
+
+def hash_file(filename, block_size=BLOCK_SIZE):
+    """Return the SHA-256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(filename, "rb") as infp:
+        while True:
+            block = infp.read(block_size)
+            if not block: break
+            h.update(block)
+    return h.hexdigest()
+
+# An optional drive letter, then anything but a colon
+pair_re = re.compile(r"^((?:[A-Za-z]:)?[^:]+):((?:[A-Za-z]:)?[^:]+)$")
+
+def split_pair(s):
+    """Split infile:outfile into a 2-tuple, or return None if not a pair."""
+    m = pair_re.match(s)
+    return m.groups() if m else None
+
+def load_manifest(filename):
+    """Read infile:outfile pairs from a file, one per line.
+
+Blank lines and lines starting with # are ignored.
+"""
+    pairs = []
+    with open(filename, "r") as infp:
+        for linenum, line in enumerate(infp, 1):
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            pair = split_pair(line)
+            if not pair:
+                raise ValueError("%s:%d: expected infile:outfile, got %s"
+                                 % (filename, linenum, line))
+            pairs.append(pair)
+    return pairs
+
+def load_hash_cache(filename):
+    """Read a JSON object mapping output paths to input hashes."""
+    try:
+        with open(filename, "r") as infp:
+            return json.load(infp)
+    except (OSError, ValueError):
+        return {}
+
+def convert_batch(pairs, decompress=False, jobs=1, hash_cache=None):
+    """Compress or decompress many files in one process.
+
+pairs -- iterable of (infile, outfile) 2-tuples
+jobs -- if greater than 1, convert in a process pool of this size
+hash_cache -- if not None, a dict mapping each outfile to the hash
+    of the input that produced it; pairs whose output exists and
+    whose input hash matches are skipped, and the dict is updated
+
+Return the list of outfiles that were written.
+"""
+    pairs = list(pairs)
+    if hash_cache is not None:
+        hashes = [hash_file(infile) for infile, outfile in pairs]
+        todo = [
+            (pair, h) for pair, h in zip(pairs, hashes)
+            if hash_cache.get(pair[1]) != h or not os.path.exists(pair[1])
+        ]
+    else:
+        todo = [(pair, None) for pair in pairs]
+
+    if jobs > 1 and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [
+                executor.submit(convert_path, infile, outfile, decompress)
+                for (infile, outfile), h in todo
+            ]
+            for future in futures: future.result()
+    else:
+        for (infile, outfile), h in todo:
+            convert_path(infile, outfile, decompress)
+
+    if hash_cache is not None:
+        hash_cache.update((pair[1], h) for pair, h in todo)
+    return [pair[1] for pair, h in todo]
+
+helpepilog = """
+Give either one infile and one outfile, or any number of
+infile:outfile pairs to convert them all in one process.
+"""
+
 def parse_argv(argv):
-    p = argparse.ArgumentParser()
-    p.add_argument("infile")
-    p.add_argument("outfile")
-    return p.parse_args(argv[1:])
+    p = argparse.ArgumentParser(epilog=helpepilog)
+    p.add_argument("--test", action="store_true",
+                   help="run self-tests, including C kernel parity "
+                   "(built with $CC if needed) on tiles from tilesets/")
+    p.add_argument("files", nargs="*",
+                   help="infile outfile (- for standard input or output), "
+                   "or infile:outfile pairs")
+    p.add_argument("-d", "--decompress", action="store_true",
+                   help="decompress PB16 data instead of compressing")
+    p.add_argument("-m", "--manifest", action="append", default=[],
+                   help="read infile:outfile pairs from this file, one per line")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="number of worker processes for batch conversion")
+    p.add_argument("--hash-cache",
+                   help="JSON file of input hashes; skip outputs whose "
+                   "input has not changed")
+    args = p.parse_args(argv[1:])
+    if args.test:
+        return args
+
+    pairs = [split_pair(x) for x in args.files]
+    if args.manifest or all(pairs):
+        if not all(pairs):
+            p.error("expected infile:outfile pairs with --manifest")
+        for filename in args.manifest:
+            pairs.extend(load_manifest(filename))
+    elif len(args.files) == 2:
+        pairs = [tuple(args.files)]
+    else:
+        p.error("expected infile and outfile or infile:outfile pairs")
+    if not pairs:
+        p.error("no files to convert")
+    args.pairs = pairs
+    return args
 
 def main(argv=None):
     args = parse_argv(argv or sys.argv)
-    with open(args.infile, "rb") as infp:
-        data = infp.read()
-    with open(args.outfile, "wb") as outfp:
-        outfp.writelines(pb16(data))
+    if args.test:
+        test()
+        return
+    hash_cache = (load_hash_cache(args.hash_cache)
+                  if args.hash_cache else None)
+    convert_batch(args.pairs, args.decompress, args.jobs, hash_cache)
+    if args.hash_cache:
+        with open(args.hash_cache, "w") as outfp:
+            json.dump(hash_cache, outfp, indent=0, sort_keys=True)
 
 def test():
-    tests = [
-        ()
-    ]
+    import random
+
     s = b"ABAHBHCHCECEFEFE"
     print(b''.join(pb16(s)).hex())
 
+    # encode() must match the reference generator, including the
+    # padding of short trailing chunks
+    rng = random.Random(144)
+    for length in range(40):
+        for alphabet in (b"AB", bytes(range(256))):
+            s = bytes(rng.choice(alphabet) for i in range(length))
+            expected = b''.join(pb16(s))
+            assert encode(s) == expected, (s.hex(), encode(s).hex())
+            assert encode(memoryview(s)) == expected
+    print("encode() matches pb16()")
+
+    # Streaming in blocks that split packets must match encode(),
+    # and decode() must restore the padded input
+    import io
+    s = bytes(rng.choice(b"ABC") for i in range(1001))
+    for block_size in (1, 3, 8, 100):
+        packed, unpacked = io.BytesIO(), io.BytesIO()
+        encode_file(io.BytesIO(s), packed, block_size)
+        assert packed.getvalue() == encode(s), block_size
+        packed.seek(0)
+        decode_file(packed, unpacked, block_size)
+        assert unpacked.getvalue() == pad_to_packet(s), block_size
+    for length in range(20):
+        s = bytes(rng.choice(b"AB") for i in range(length))
+        assert decode(encode(s)) == pad_to_packet(s), s.hex()
+    print("streaming encode and decode round trip")
+
+    # The C kernel must match the Python path on random data and on
+    # tiles converted from the images in tilesets/.  Build it in a
+    # temporary folder if it isn't already built.
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kernel = encode_packets_c or build_accel(tmpdir)
+        if not kernel:
+            print("C kernel not available; skipping parity test")
+            return
+        samples = [
+            bytes(rng.choice(alphabet) for i in range(length))
+            for length in range(0, 2048, 8)
+            for alphabet in (b"AB", b"ABCD", bytes(range(256)))
+        ]
+        chrsamples = load_test_tiles()
+        samples.extend(chrsamples)
+        for s in samples:
+            for prev in (b"\0\0", b"AB"):
+                assert kernel(s, prev) == encode_packets_py(s, prev), s.hex()
+    print("C kernel matches Python on %d samples (%d converted images)"
+          % (len(samples), len(chrsamples)))
+
+def load_test_tiles():
+    """Convert tilesets/*.png to Game Boy CHR data for test().
+
+Return a list of CHR data, one per image, or an empty list if
+Pillow is not installed.
+"""
+    import glob
+    try:
+        from PIL import Image
+        from pilbmp2nes import pilbmp2chr, compileTilePlanar
+    except ImportError:
+        print("Pillow not installed; testing without converted tiles")
+        return []
+    gbformat = compileTilePlanar("0,1")
+    topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = []
+    for filename in sorted(glob.glob(os.path.join(topdir, "tilesets", "*.png"))):
+        im = Image.open(filename)
+        if im.mode not in ('P', 'L'):
+            im = im.convert("RGB").quantize(4)
+        out.append(pad_to_packet(b"".join(pilbmp2chr(im, formatTile=gbformat))))
+    return out
+
 if __name__=='__main__':
     main()
 ##    test()
@@ -12,6 +12,136 @@
 from __future__ import with_statement, print_function, unicode_literals
 from PIL import Image
 from time import sleep
+from functools import lru_cache
+from collections import OrderedDict
+import sys
+import hashlib
+try:
+    import chrcache
+except ImportError:
+    chrcache = None
+
+def parsePlanemap(planemap):
+    """Parse a plane map string into [tile plane][row plane][bit number]."""
+    return [[[int(c) for c in row]
+             for row in plane.split(',')]
+            for plane in planemap.split(';')]
+
+class TilePlanarFormat(object):
+    """Bitplane converter for 8x8 tiles, compiled once per plane map.
+
+Planemap opcodes are as for formatTilePlanar().  Call it with an
+8x8 tile image, or call formatTiles() with any number of tiles'
+pixel values as bytes, 64 per tile in row-major order.
+
+Each output byte of a row collects the bits of 1, 2, 4, or 8 pixels
+in one column each.  For each (byte, column) pair, a 256-entry
+translate table maps a pixel value to its bits at its position in
+that byte, so a whole column of 8 rows converts in one step.
+"""
+    def __init__(self, planemap, hflip=False, little=False):
+        self.planemap = parsePlanemap(planemap)
+        self.hflip, self.little = hflip, little
+        self.key = (planemap, hflip, little)
+
+        # plan[tile plane][byte within row] = [(column, table), ...]
+        self.plan = None
+        if all(8 % len(rowplane) == 0
+               for plane in self.planemap for rowplane in plane):
+            self.plan = [self.compilePlane(plane) for plane in self.planemap]
+        self.tileBytes = len(self.formatTiles(bytes(64)))
+
+    def compilePlane(self, plane):
+        rowbytes = []
+        for rowplane in plane:
+            bitsperpx = len(rowplane)
+            pxperbyte = 8 // bitsperpx
+            codes = [0] * 256
+            for bitnum in rowplane:
+                codes = [(c << 1) | ((v >> bitnum) & 1)
+                         for v, c in enumerate(codes)]
+            thisrowplane = [[] for i in range(bitsperpx)]
+            for x in range(8):
+                pos = 7 - x if self.hflip else x
+                shift = bitsperpx * (pxperbyte - 1 - pos % pxperbyte)
+                table = bytes(c << shift for c in codes)
+                thisrowplane[pos // pxperbyte].append((x, table))
+            if self.little:
+                thisrowplane.reverse()
+            rowbytes.extend(thisrowplane)
+        return rowbytes
+
+    def formatTiles(self, pixels):
+        """Convert tiles' pixel values to bitplanes.
+
+pixels -- 64 bytes per tile
+Return all tiles' bitplanes, self.tileBytes bytes per tile.
+
+A column of every tile converts at once: translate through each
+table, OR as big ints, and scatter each row's bytes into place.
+"""
+        if self.plan is None:
+            return b"".join(self.formatPixelsSlow(pixels[i:i + 64])
+                            for i in range(0, len(pixels), 64))
+        nrows = len(pixels) // 8
+        columns = [pixels[x::8] for x in range(8)]
+        tilebytes = 8 * sum(len(plane) for plane in self.plan)
+        out = bytearray(tilebytes * (nrows // 8))
+        offset = 0
+        for plane in self.plan:
+            for i, byteplan in enumerate(plane):
+                rows = 0
+                for x, table in byteplan:
+                    rows |= int.from_bytes(columns[x].translate(table), "big")
+                rows = rows.to_bytes(nrows, "big")
+                for y in range(8):
+                    out[offset + y * len(plane) + i::tilebytes] = rows[y::8]
+            offset += 8 * len(plane)
+        return bytes(out)
+
+    def formatPixelsSlow(self, pixels):
+        """Convert pixels to bitplanes one bit at a time.
+
+Used for row planes whose bits per pixel don't divide 8, where
+a pixel's bits can straddle two bytes.
+"""
+        pixelrows = [list(pixels[i:i + 8]) for i in range(0, 64, 8)]
+        if self.hflip:
+            for row in pixelrows:
+                row.reverse()
+        out = bytearray()
+
+        # we have five (!) nested loops
+        # outermost: separate planes
+        # within separate planes: pixel rows
+        # within pixel rows: row planes
+        # within row planes: pixels
+        # within pixels: bits
+        for plane in self.planemap:
+            for pxrow in pixelrows:
+                for rowplane in plane:
+                    rowbits = 1
+                    thisrow = bytearray()
+                    for px in pxrow:
+                        for bitnum in rowplane:
+                            rowbits = (rowbits << 1) | ((px >> bitnum) & 1)
+                            if rowbits >= 0x100:
+                                thisrow.append(rowbits & 0xFF)
+                                rowbits = 1
+                    out.extend(thisrow[::-1] if self.little else thisrow)
+        return bytes(out)
+
+    def __call__(self, tile):
+        if (tile.size != (8, 8)):
+            return None
+        if tile.mode in ('P', 'L'):
+            return self.formatTiles(tile.tobytes())
+        return self.formatTiles(bytes(tile.getdata()))
+
+@lru_cache(maxsize=None)
+def compileTilePlanar(planemap, hflip=False, little=False):
+    """Get a TilePlanarFormat for a plane map, reusing one if already built."""
+    return TilePlanarFormat(planemap, bool(hflip), bool(little))
 
 def formatTilePlanar(tile, planemap, hflip=False, little=False):
     """Turn a tile into bitplanes.
@@ -23,45 +153,178 @@ Planemap opcodes:
 0,1;2,3 -- SNES/PCE format
 
 """
-    hflip = 7 if hflip else 0
-    if (tile.size != (8, 8)):
-        return None
-    pixels = list(tile.getdata())
-    pixelrows = [pixels[i:i + 8] for i in range(0, 64, 8)]
-    if hflip:
-        for row in pixelrows:
-            row.reverse()
-    out = bytearray()
-
-    planemap = [[[int(c) for c in row]
-                 for row in plane.split(',')]
-                for plane in planemap.split(';')]
-    # format: [tile-plane number][plane-within-row number][bit number]
-
-    # we have five (!) nested loops
-    # outermost: separate planes
-    # within separate planes: pixel rows
-    # within pixel rows: row planes
-    # within row planes: pixels
-    # within pixels: bits
-    for plane in planemap:
-        for pxrow in pixelrows:
-            for rowplane in plane:
-                rowbits = 1
-                thisrow = bytearray()
-                for px in pxrow:
-                    for bitnum in rowplane:
-                        rowbits = (rowbits << 1) | ((px >> bitnum) & 1)
-                        if rowbits >= 0x100:
-                            thisrow.append(rowbits & 0xFF)
-                            rowbits = 1
-                out.extend(thisrow[::-1] if little else thisrow)
+    return compileTilePlanar(planemap, hflip, little)(tile)
+
+def subpaletteTable(addamt=0, addamt0=None):
+    """Make a 256-entry table that adds addamt to each pixel value.
+
+addamt0 -- value to add to color 0 instead (default: addamt)
+Sums wrap around modulo 256.
+"""
+    if addamt0 is None: addamt0 = addamt
+    return bytes([addamt0 & 0xFF]) + bytes((i + addamt) & 0xFF
+                                           for i in range(1, 256))
+
+def imageToTilePixels(im, tileWidth=8, tileHeight=8, pixelMap=None):
+    """Reorder an image's pixels into 8x8 tiles in pilbmp2chr() order.
+
+im -- image in mode P or L
+tileWidth, tileHeight -- metatile size, multiples of 8
+pixelMap -- if not None, a 256-byte table to translate pixels through
+Return bytes with 64 pixel values per tile, padding the image's
+right and bottom with 0 to a multiple of the metatile size.
+"""
+    (w, h) = im.size
+    mtcols, mtrows = -(-w // tileWidth), -(-h // tileHeight)
+    padw, padh = mtcols * tileWidth, mtrows * tileHeight
+    data = im.tobytes()
+    if pixelMap is not None:
+        data = data.translate(pixelMap)
+    if (padw, padh) != (w, h):
+        padded = bytearray(padw * padh)
+        for y in range(h):
+            padded[y * padw:y * padw + w] = data[y * w:y * w + w]
+        data = padded
+
+    # Move 8-pixel slivers as 8-byte units.  For each tile column and
+    # row within a metatile, one strided copy covers all metatile rows.
+    src = memoryview(data).cast('Q')
+    out = bytearray(padw * padh)
+    dst = memoryview(out).cast('Q')
+    srccols, mtw, mth = padw // 8, tileWidth // 8, tileHeight // 8
+    srcstride = srccols * tileHeight
+    dststride = mtcols * mtw * mth * 8
+    for tx in range(srccols):
+        mt_x, tile_x = divmod(tx, mtw)
+        for tile_y in range(mth):
+            dststart = ((mt_x * mth + tile_y) * mtw + tile_x) * 8
+            srcstart = tile_y * 8 * srccols + tx
+            for y in range(8):
+                dst[dststart + y::dststride] = (
+                    src[srcstart + y * srccols::srcstride]
+                )
     return bytes(out)
 
+# Sidecar tile index: magic, then length-prefixed format key, then
+# tile size, count, and that many (digest, converted tile) records
+TILE_INDEX_MAGIC = b"P2Nidx1\n"
+TILE_DIGEST_SIZE = 16
+
+def tileDigest(pixels):
+    return hashlib.blake2b(pixels, digest_size=TILE_DIGEST_SIZE).digest()
+
+def loadTileIndex(filename, formatTile):
+    """Read a sidecar tile index made with the same tile format.
+
+Return a dict from tile pixel digest to converted tile, which is
+empty if the file is missing, damaged, or for another format.
+"""
+    try:
+        with open(filename, "rb") as infp:
+            data = infp.read()
+    except OSError:
+        return {}
+    magiclen = len(TILE_INDEX_MAGIC)
+    if data[:magiclen] != TILE_INDEX_MAGIC: return {}
+    keylen = int.from_bytes(data[magiclen:magiclen + 2], "little")
+    pos = magiclen + 2 + keylen
+    if data[magiclen + 2:pos] != repr(formatTile.key).encode("utf-8"):
+        return {}
+    tileBytes = int.from_bytes(data[pos:pos + 2], "little")
+    count = int.from_bytes(data[pos + 2:pos + 6], "little")
+    pos += 6
+    recsize = TILE_DIGEST_SIZE + tileBytes
+    if (tileBytes != formatTile.tileBytes
+        or len(data) != pos + count * recsize):
+        return {}
+    return {
+        data[i:i + TILE_DIGEST_SIZE]: data[i + TILE_DIGEST_SIZE:i + recsize]
+        for i in range(pos, len(data), recsize)
+    }
+
+def saveTileIndex(filename, formatTile, index):
+    """Write a dict from tile pixel digest to converted tile."""
+    key = repr(formatTile.key).encode("utf-8")
+    out = [
+        TILE_INDEX_MAGIC, len(key).to_bytes(2, "little"), key,
+        formatTile.tileBytes.to_bytes(2, "little"),
+        len(index).to_bytes(4, "little")
+    ]
+    for digest, tile in index.items():
+        out.append(digest)
+        out.append(tile)
+    with open(filename, "wb") as outfp:
+        outfp.writelines(out)
+
+def formatTilesIncremental(formatTile, pixels, sidecar):
+    """Convert tiles, reusing those unchanged since the last run.
+
+formatTile -- a TilePlanarFormat
+pixels -- 64 bytes per tile
+sidecar -- filename of the tile index from the last run, which
+    is replaced with one for these tiles
+"""
+    index = loadTileIndex(sidecar, formatTile)
+    digests = [tileDigest(pixels[i:i + 64])
+               for i in range(0, len(pixels), 64)]
+
+    # Convert only tiles not seen last time, all in one batch
+    changed = OrderedDict()
+    for i, digest in enumerate(digests):
+        if digest not in index:
+            changed.setdefault(digest, i)
+    if changed:
+        newpixels = b"".join(pixels[i * 64:i * 64 + 64]
+                             for i in changed.values())
+        newdata = formatTile.formatTiles(newpixels)
+        sz = formatTile.tileBytes
+        for j, digest in enumerate(changed):
+            index[digest] = newdata[j * sz:j * sz + sz]
+
+    saveTileIndex(sidecar, formatTile, {d: index[d] for d in digests})
+    return b"".join(index[d] for d in digests)
+
 def pilbmp2chr(im, tileWidth=8, tileHeight=8,
-               formatTile=lambda im: formatTilePlanar(im, "0;1")):
-    """Convert a bitmap image into a list of byte strings representing tiles."""
+               formatTile=compileTilePlanar("0;1"), pixelMap=None,
+               sidecar=None):
+    """Convert a bitmap image into a list of byte strings representing tiles.
+
+pixelMap -- if not None, a 256-byte table such as from
+    subpaletteTable() to translate pixel values through as they
+    are read; padding past the image's edges stays 0
+sidecar -- if not None, filename of a tile index used to convert
+    only tiles whose pixels changed since the last run
+
+If chrcache has a default cache, results of the whole-image path
+are cached by tile pixels and plane map.
+"""
     im.load()
+
+    # Convert the whole image at once if possible
+    if (isinstance(formatTile, TilePlanarFormat) and im.mode in ('P', 'L')
+        and tileWidth % 8 == 0 and tileHeight % 8 == 0):
+        pixels = imageToTilePixels(im, tileWidth, tileHeight, pixelMap)
+        cache = chrcache and chrcache.get_default()
+        outdata = None
+        if cache:
+            key = chrcache.make_key("pilbmp2chr",
+                                    chrcache.source_digest(__file__),
+                                    formatTile.key, pixels)
+            outdata = cache.get(key)
+        if outdata is None:
+            if sidecar:
+                outdata = formatTilesIncremental(formatTile, pixels, sidecar)
+            else:
+                outdata = formatTile.formatTiles(pixels)
+            if cache:
+                cache.put(key, outdata)
+        sz = formatTile.tileBytes
+        return [outdata[i:i + sz] for i in range(0, len(outdata), sz)]
+
+    # The crop path translates the whole image once, before cropping,
+    # so that padding past its edges stays 0
+    if pixelMap is not None:
+        im = im.point(list(pixelMap))
     (w, h) = im.size
     outdata = []
     for mt_y in range(0, h, tileHeight):
@@ -86,9 +349,12 @@ def parse_argv(argv):
     parser.add_option("-W", "--tile-width", dest="tileWidth",
                       help="set width of metatiles", metavar="HEIGHT",
                       type="int", default=8)
-    parser.add_option("--packbits", dest="packbits",
+    parser.add_option("--packbits", dest="compression",
                       help="use PackBits RLE compression",
-                      action="store_true", default=False)
+                      action="store_const", const="packbits", default=None)
+    parser.add_option("--pb16", dest="compression",
+                      help="use PB16 compression",
+                      action="store_const", const="pb16")
     parser.add_option("-H", "--tile-height", dest="tileHeight",
                       help="set height of metatiles", metavar="HEIGHT",
                       type="int", default=8)
@@ -109,6 +375,10 @@ def parse_argv(argv):
     parser.add_option("--add0", dest="addamt0",
                       help="value to add to pixels of color 0 (if different)",
                       type="int", default=None)
+    parser.add_option("--sidecar", dest="sidecar",
+                      help="keep an index of converted tiles in SIDECAR and "
+                      "convert only tiles changed since the last run",
+                      metavar="SIDECAR", default=None)
     (options, args) = parser.parse_args(argv[1:])
 
     tileWidth = int(options.tileWidth)
@@ -135,7 +405,6 @@ def parse_argv(argv):
         except StopIteration:
             outfilename = '-'
     if outfilename == '-':
-        import sys
         if sys.stdout.isatty():
             raise ValueError("cannot write CHR to terminal")
 
@@ -143,8 +412,8 @@ def parse_argv(argv):
     if addamt0 is None: addamt0 = addamt
 
     return (infilename, outfilename, tileWidth, tileHeight,
-            options.packbits, options.planes, options.hflip, options.little,
-            addamt, addamt0)
+            options.compression, options.planes, options.hflip, options.little,
+            addamt, addamt0, options.sidecar)
 
 argvTestingMode = True
 
@@ -158,53 +427,168 @@ def make_stdout_binary():
         import os, msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
 
-def main(argv=None):
-    import sys
-    if argv is None:
-        argv = sys.argv
-        if (argvTestingMode and len(argv) < 2
-            and sys.stdin.isatty() and sys.stdout.isatty()):
-            argv.extend(input('args:').split())
-    try:
-        (infilename, outfilename, tileWidth, tileHeight,
-         usePackBits, planes, hflip, little,
-         addamt, addamt0) = parse_argv(argv)
-    except Exception as e:
-        sys.stderr.write("%s: %s\n" % (argv[0], str(e)))
-        sys.exit(1)
+def compressTiles(tiles, compression=None):
+    """Compress an iterable of tiles one tile at a time.
 
-    im = Image.open(infilename)
+compression -- None, "packbits" (prefixed with the big-endian
+    uncompressed size modulo 65536), or "pb16"
+
+Return a generator of bytes.  PB16 output is yielded as each tile
+is compressed.  PackBits output is held until the last tile because
+the size prefix comes first.
+"""
+    if compression is None:
+        yield from tiles
+        return
+    if compression == "pb16":
+        import pb16
+        enc = pb16.Encoder()
+        for tile in tiles:
+            yield enc.encode(tile)
+        yield enc.flush()
+        return
+    if compression != "packbits":
+        raise ValueError("unknown compression %s" % compression)
+
+    import packbits
+    enc = packbits.Encoder()
+    sz = 0
+    out = []
+    for tile in tiles:
+        sz += len(tile)
+        out.append(enc.encode(tile))
+    out.append(enc.flush())
+    sz %= 0x10000
+    yield bytes([sz >> 8, sz & 0xFF])
+    yield from out
+
+def convertImage(im, tileWidth=8, tileHeight=8, compression=None,
+                 planes="0;1", hflip=False, little=False,
+                 addamt=0, addamt0=0, sidecar=None):
+    """Convert an opened image to CHR data with main()'s options."""
 
     # Subpalette shift
+    pixelMap = None
     if addamt or addamt0:
-        px = bytearray(im.getdata())
-        for i in range(len(px)):
-            thispixel = px[i]
-            px[i] = thispixel + (addamt if thispixel else addamt0)
-        im.putdata(px)
+        pixelMap = subpaletteTable(addamt, addamt0)
 
     outdata = pilbmp2chr(im, tileWidth, tileHeight,
-                         lambda im: formatTilePlanar(im, planes, hflip, little))
-    outdata = b''.join(outdata)
-    if usePackBits:
-        from packbits import PackBits
-        sz = len(outdata) % 0x10000
-        outdata = PackBits(outdata).flush().tostring()
-        outdata = b''.join([chr(sz >> 8), chr(sz & 0xFF), outdata])
-
-    # Write output file
+                         compileTilePlanar(planes, hflip, little), pixelMap,
+                         sidecar)
+    return b''.join(compressTiles(outdata, compression))
+
+def writeChr(outfilename, outdata):
+    """Write CHR data to a file or, if outfilename is '-', standard output."""
     outfp = None
     try:
         if outfilename != '-':
             outfp = open(outfilename, 'wb')
         else:
-            outfp = sys.stdout
             make_stdout_binary()
+            outfp = getattr(sys.stdout, 'buffer', sys.stdout)
         outfp.write(outdata)
     finally:
         if outfp and outfilename != '-':
             outfp.close()
 
+def runImageJobs(infilename, jobs):
+    """Open one image and run all conversions of it.
+
+jobs -- list of parse_argv() results that share infilename
+"""
+    im = Image.open(infilename)
+    im.load()
+    for job in jobs:
+        writeChr(job[1], convertImage(im, *job[2:]))
+    return infilename
+
+def loadManifest(filename):
+    """Read conversion jobs from a manifest file.
+
+Each line holds the arguments for one conversion, as they would
+appear on pilbmp2nes.py's command line.  Blank lines and lines
+starting with # are ignored.
+"""
+    import shlex
+    jobs = []
+    with open(filename, "r") as infp:
+        for linenum, line in enumerate(infp, 1):
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            try:
+                jobs.append(parse_argv(["pilbmp2nes.py"] + shlex.split(line)))
+            except Exception as e:
+                raise ValueError("%s:%d: %s" % (filename, linenum, e))
+    return jobs
+
+def runBatch(jobs, numWorkers=None):
+    """Run conversion jobs, decoding each image once.
+
+jobs -- list of parse_argv() results
+numWorkers -- size of process pool (None: one per CPU core;
+    1: convert in this process)
+"""
+    byimage = OrderedDict()
+    for job in jobs:
+        byimage.setdefault(job[0], []).append(job)
+    if numWorkers == 1 or len(byimage) < 2:
+        for infilename, imjobs in byimage.items():
+            runImageJobs(infilename, imjobs)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(numWorkers) as executor:
+        futures = [executor.submit(runImageJobs, infilename, imjobs)
+                   for infilename, imjobs in byimage.items()]
+        for future in futures:
+            future.result()
+
+    # Workers exit without running atexit handlers, so enforce the
+    # cache's size limit here
+    cache = chrcache and chrcache.get_default()
+    if cache:
+        cache.evict()
+
+def parse_batch_argv(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage="usage: %prog --batch MANIFEST [-j JOBS]")
+    parser.add_option("--batch", dest="manifest",
+                      help="read one set of converter arguments per line "
+                      "from MANIFEST", metavar="MANIFEST")
+    parser.add_option("-j", "--jobs", dest="numWorkers",
+                      help="convert JOBS images at once (default: one per "
+                      "CPU core)", metavar="JOBS", type="int", default=None)
+    (options, args) = parser.parse_args(argv[1:])
+    if args:
+        raise ValueError("unexpected arguments in batch mode: %s"
+                         % " ".join(args))
+    return options.manifest, options.numWorkers
+
+def batch_main(argv):
+    try:
+        manifest, numWorkers = parse_batch_argv(argv)
+        jobs = loadManifest(manifest)
+    except Exception as e:
+        sys.stderr.write("%s: %s\n" % (argv[0], str(e)))
+        sys.exit(1)
+    runBatch(jobs, numWorkers)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+        if (argvTestingMode and len(argv) < 2
+            and sys.stdin.isatty() and sys.stdout.isatty()):
+            argv.extend(input('args:').split())
+    if len(argv) > 1 and argv[1].startswith('--batch'):
+        return batch_main(argv)
+    try:
+        job = parse_argv(argv)
+    except Exception as e:
+        sys.stderr.write("%s: %s\n" % (argv[0], str(e)))
+        sys.exit(1)
+
+    im = Image.open(job[0])
+    writeChr(job[1], convertImage(im, *job[2:]))
+
 if __name__=='__main__':
     main()
 ##    main(['pilbmp2nes.py', '../tilesets/char_pinocchio.png', 'char_pinocchio.chr'])
@@ -117,11 +117,18 @@ defined (as a text macro) but not exported.  So instead, this program
 calculates all functions' start and end offsets.  Though it needs
 to be re-run whenever any source file changes, this still completes
 faster than (say) link-time optimization (LTO) of a C++ program.
+With `--cache`, it saves each file's parse results and parses again
+only files whose contents changed since the last run, and `-j`
+parses them in parallel.  With `--watch`, it keeps running, checks
+source files for changes every half second, and rewrites the output
+only when the allocation changes, so that make rebuilds only what
+depends on changed variables.
 """
 
-import os, sys, argparse
+import os, sys, argparse, io, hashlib, pickle, tempfile, contextlib, time
 from collections import defaultdict
 from itertools import chain
+from array import array
 
 # rgbasm parsing ####################################################
 
@@ -139,6 +146,12 @@ def rgbint(s):
     return int(s[1:], 10)
 
 class AsmFile(object):
+    # Results used once parsing ends.  Pickling keeps only these
+    # so that cached and worker process results stay small.
+    result_fields = (
+        'linenum', 'exports', 'calls', 'tailcalls', 'locals_size', 'warnings'
+    )
+
     def __init__(self, lines=None):
         self.toplabel = self.jumptable_contents = None
         self.last_was_jump = False
@@ -153,6 +166,13 @@ class AsmFile(object):
         self.locals_size = {}  # {funcname: [(varname, size), ...], ...}
         if lines: self.extend(lines)
 
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.result_fields}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
     def extend(self, lines):
         for line in lines: self.append(line)
 
@@ -430,35 +450,172 @@ Convert '56' and '$38' to '$0038' and 'routine.loop' to 'routine'.
                   else '')
         return is_conditional, target
 
-def load_files(filenames, verbose=False):
+def read_source(filename):
+    with open(filename, "rb") as infp:
+        return infp.read()
+
+def parse_source(filename, data, verbose=False):
+    """Parse the contents of one source code file.
+
+filename -- name used in diagnostics
+data -- contents of the file as bytes
+verbose -- if True, print exception stack traces to stderr
+
+Return a 3-tuple (result, errors, warnings)
+- result -- AsmFile instance, or None if parsing failed
+- errors -- [(filename, linenum, msg), ...] of exceptions
+- warnings -- [(filename, linenum, msg), ...] of warnings
+"""
+    result, errors = AsmFile(), []
+    try:
+        # Decode and split lines the same way as open(filename, "r")
+        result.extend(io.TextIOWrapper(io.BytesIO(data)))
+        result.end_section()
+    except Exception as e:
+        if verbose:
+            from traceback import print_exc
+            print_exc()
+        errors.append((filename, result.linenum, str(e)))
+    warnings = [(filename, ln, msg) for ln, msg in result.warnings]
+    return (None if errors else result), errors, warnings
+
+def parse_job(job):
+    """Parse a (filename, data, verbose) tuple, possibly in a worker process.
+
+Return (parse_source() result, text of stack traces), so that the
+caller can print stack traces in the order of filenames.
+"""
+    filename, data, verbose = job
+    if not verbose:
+        return parse_source(filename, data), ''
+    trace = io.StringIO()
+    with contextlib.redirect_stderr(trace):
+        parsed = parse_source(filename, data, verbose)
+    return parsed, trace.getvalue()
+
+# Change this when parsing the same source produces different results
+PARSE_CACHE_VERSION = 1
+
+def parse_cache_version():
+    """Identify the parser that produces cached results.
+
+Combines PARSE_CACHE_VERSION with a hash of this file, so that any
+edit to the parser discards results it saved before.
+"""
+    with open(__file__, "rb") as infp:
+        digest = hashlib.sha256(infp.read()).hexdigest()
+    return "%d:%s" % (PARSE_CACHE_VERSION, digest)
+
+class ParseCache(object):
+    """Parse results saved between runs, keyed by source filename.
+
+Each entry is (mtime_ns, size, digest, parse_source() result).
+A file whose modification time and size match its entry is not
+read at all, and one whose contents hash the same is not parsed.
+Only files that parsed without errors are cached, so that -v can
+still print their stack traces.  If filename is None, entries are
+kept only in memory.
+"""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.stamps = {}  # {filename: (mtime_ns, size, digest), ...}
+        self.used = set()
+        self.version = parse_cache_version()
+        if not filename: return
+        try:
+            with open(filename, "rb") as infp:
+                version, entries = pickle.load(infp)
+        except Exception:
+            # A missing or unreadable cache only costs speed
+            return
+        if version == self.version:
+            self.entries = entries
+
+    def get(self, filename):
+        """Look up saved parse_source() results for a file.
+
+Return (results or None, contents or None if not read).  If results
+is None, pass the file's new results to put().
+"""
+        self.used.add(filename)
+        st = os.stat(filename)
+        stamp = st.st_mtime_ns, st.st_size
+        entry = self.entries.get(filename)
+        if entry and entry[:2] == stamp:
+            return entry[3], None
+        data = read_source(filename)
+        digest = hashlib.sha256(data).digest()
+        if entry and entry[2] == digest:
+            self.entries[filename] = stamp + (digest, entry[3])
+            return entry[3], data
+        self.stamps[filename] = stamp + (digest,)
+        return None, data
+
+    def put(self, filename, parsed):
+        """Save parse_source() results for a file that get() missed."""
+        stamp = self.stamps.pop(filename)
+        if parsed[1]:
+            self.entries.pop(filename, None)
+        else:
+            self.entries[filename] = stamp + (parsed,)
+
+    def save(self):
+        """Write entries for the files parsed this run, replacing the cache atomically."""
+        if not self.filename: return
+        entries = {k: v for k, v in self.entries.items() if k in self.used}
+        folder = os.path.dirname(self.filename) or "."
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as outfp:
+                pickle.dump((self.version, entries), outfp,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self.filename)
+        except OSError as e:
+            print("savescan.py: %s" % e, file=sys.stderr)
+
+def load_files(filenames, verbose=False, cache=None, jobs=1):
     """Load and parse source code files.
 
 filenames -- iterable of things to open()
 verbose -- if True, print exception stack traces to stderr
+cache -- a ParseCache to reuse results of files that haven't changed
+jobs -- if greater than 1, parse in a process pool of this size
 
-Return a 2-tuple (files, all_errors, all_warnings)
+Return a 3-tuple (files, all_errors, all_warnings)
 - files -- {filename: AsmFile instance, ...}
 - all_errors -- [(filename, linenum, msg), ...] of exceptions
-- all_warnings -- (filename, linenum, msg), ...] of warnings
+- all_warnings -- [(filename, linenum, msg), ...] of warnings
+
+Results are in the order of filenames no matter which files came
+from the cache or which worker finished first.
 """
-    if verbose:
-        from traceback import print_exc
+    filenames = list(filenames)
+    parsed = [None] * len(filenames)
+    todo = []  # [(index into filenames, (filename, data, verbose)), ...]
+    for i, filename in enumerate(filenames):
+        data = None
+        if cache: parsed[i], data = cache.get(filename)
+        if parsed[i] is None:
+            if data is None: data = read_source(filename)
+            todo.append((i, (filename, data, verbose)))
+
+    if jobs > 1 and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(parse_job, [job for i, job in todo]))
+    else:
+        results = [parse_job(job) for i, job in todo]
+    for (i, job), (result, trace) in zip(todo, results):
+        if trace: sys.stderr.write(trace)
+        parsed[i] = result
+        if cache: cache.put(job[0], result)
 
     files, all_errors, all_warnings = {}, [], []
-    for filename in filenames:
-        with open(filename, "r") as infp:
-            result = AsmFile()
-            try:
-                result.extend(infp)
-                result.end_section()
-            except Exception as e:
-                if verbose: print_exc()
-                all_errors.append((filename, result.linenum, str(e)))
-            else:
-                files[filename] = result
-            finally:
-                all_warnings.extend((filename, ln, msg)
-                                    for ln, msg in result.warnings)
+    for filename, (result, errors, warnings) in zip(filenames, parsed):
+        if result is not None: files[filename] = result
+        all_errors.extend(errors)
+        all_warnings.extend(warnings)
     return files, all_errors, all_warnings
 
 # call graph sorting and allocation #################################
@@ -485,114 +642,280 @@ errors -- [(filename, linenum, msg), ...]
                                    "%s had been exported here" % symbol))
     return all_exports, all_errors
 
-def postorder_callees(files, exports, start_label="$0100"):
-    """Sort labels reachable from the start by callees first.
+def resolve_callees(files, exports, routine_key):
+    """Find the keys of a routine's callees and tail callees.
 
-files: a dict {filename: AsmFile instance, ...}
-exports: a dict {label: (filename, ...), ...}
-start_label: the first label to call (in GB, usually $0100)
+A callee that isn't exported is assumed to be in the caller's file.
 
-Return (toposort, itoposort)
-where toposort is [(filename, label), ...]
-and itoposort is its inverse {(filename, label): index into toposort, ...}
+Return ([(filename, label), ...], [(filename, label), ...])
 """
-    # stack is a list of stack frames to be visited
-    # each stack frame is [(module, label), ...]
-    stack = [[(exports[start_label][0], start_label)]]
-    itoposort = {}  # {(filename, label): index, ...}
-    while stack:
-        stackframe = stack.pop()
-        routine_key = stackframe[-1]
-        filename, label = routine_key
-        assert filename is not None
-        if routine_key in itoposort: continue
-
-        # Find all callees that aren't already in the toposort
-        # or in the stack
-        module = files[filename]
-        callees = module.calls[label]
-        tailcallees = module.tailcalls[label]
-        new_callees = []
-        for callee in chain(callees, tailcallees):
+    filename, label = routine_key
+    module = files[filename]
+    out = []
+    for callees in (module.calls.get(label, ()),
+                    module.tailcalls.get(label, ())):
+        keys = []
+        for callee in sorted(callees):
             try:
-                callee_filename = exports[callee]
+                callee_filename = exports[callee][0]
             except KeyError:
                 callee_filename = filename
+            keys.append((callee_filename, callee))
+        out.append(keys)
+    return tuple(out)
+
+class CallGraph(object):
+    """A call graph with each (filename, label) numbered.
+
+keys -- [(filename, label), ...] indexed by node number
+key_index -- {(filename, label): node number, ...}
+call_offsets, call_targets -- callees of node i are
+    call_targets[call_offsets[i]:call_offsets[i + 1]]
+tail_offsets, tail_targets -- tail callees in the same form
+local_sizes -- total size of each node's local variables
+
+Edges are in resolve_callees() order.
+"""
+    def __init__(self):
+        self.keys, self.key_index = [], {}
+        self.call_offsets, self.call_targets = array('I', [0]), array('I')
+        self.tail_offsets, self.tail_targets = array('I', [0]), array('I')
+        self.local_sizes = array('I')
+
+    def intern(self, key):
+        """Return the node number of a (filename, label), adding it if new."""
+        try:
+            return self.key_index[key]
+        except KeyError:
+            self.key_index[key] = node = len(self.keys)
+            self.keys.append(key)
+            return node
+
+    def callees(self, node):
+        return self.call_targets[self.call_offsets[node]:self.call_offsets[node + 1]]
+
+    def tailcallees(self, node):
+        return self.tail_targets[self.tail_offsets[node]:self.tail_offsets[node + 1]]
+
+def build_call_graph(files, exports):
+    """Number all labels in parsed files and compile their calls into arrays.
+
+files -- {filename: AsmFile instance, ...}
+exports -- {symbol: (filename, ...), ...}
+
+Return a CallGraph
+"""
+    graph = CallGraph()
+    for symbol, (filename, _) in exports.items():
+        graph.intern((filename, symbol))
+    for filename, module in files.items():
+        for label in chain(module.calls, module.tailcalls, module.locals_size):
+            graph.intern((filename, label))
+
+    # Callees not yet numbered are added to the end and get their
+    # edges when the loop reaches them
+    node = 0
+    while node < len(graph.keys):
+        routine_key = graph.keys[node]
+        callees, tailcallees = resolve_callees(files, exports, routine_key)
+        graph.call_targets.extend(graph.intern(k) for k in callees)
+        graph.call_offsets.append(len(graph.call_targets))
+        graph.tail_targets.extend(graph.intern(k) for k in tailcallees)
+        graph.tail_offsets.append(len(graph.tail_targets))
+        filename, label = routine_key
+        func_locals = files[filename].locals_size.get(label, ())
+        graph.local_sizes.append(sum(row[1] for row in func_locals))
+        node += 1
+    return graph
+
+def postorder_callees(graph, start_key):
+    """Sort nodes reachable from the start by callees first.
+
+graph -- a CallGraph
+start_key -- (filename, label) of the first label to call
+    (in GB, usually $0100)
+
+This is Tarjan's strongly connected components algorithm, which
+visits each node and edge once.  Callees are visited in reverse order
+of tail callees then callees, and a callee that would close a loop
+is skipped.
+
+Return (toposort, loops)
+where toposort is array('I') of node numbers
+and loops is a list of strongly connected components with more than
+one node or a node that calls itself, each a list of node numbers in
+the order first visited.  These are recursion or tailcall loops, and
+a component's members can't all be placed after one another.
+"""
+    num_nodes = len(graph.keys)
+    call_offsets, call_targets = graph.call_offsets, graph.call_targets
+    tail_offsets, tail_targets = graph.tail_offsets, graph.tail_targets
+    toposort = array('I')
+    visit_index = array('i', [-1]) * num_nodes  # order DFS reached each node
+    lowlink = array('i', [-1]) * num_nodes  # earliest node reachable from each
+    on_tarjan_stack = bytearray(num_nodes)
+    tarjan_stack, loops = [], []
+    num_visited = 0
+
+    # Each DFS frame is a node and how many of its callees and then
+    # tail callees remain to be visited, counting down
+    def push(node):
+        nonlocal num_visited
+        visit_index[node] = lowlink[node] = num_visited
+        num_visited += 1
+        tarjan_stack.append(node)
+        on_tarjan_stack[node] = 1
+        stack_nodes.append(node)
+        stack_remain.append(call_offsets[node + 1] - call_offsets[node]
+                            + tail_offsets[node + 1] - tail_offsets[node])
+    stack_nodes, stack_remain = [], []
+    push(graph.key_index[start_key])
+    while stack_nodes:
+        node = stack_nodes[-1]
+        remain = stack_remain[-1]
+        if remain:
+            remain -= 1
+            stack_remain[-1] = remain
+            num_calls = call_offsets[node + 1] - call_offsets[node]
+            if remain >= num_calls:
+                callee = tail_targets[tail_offsets[node] + remain - num_calls]
             else:
-                callee_filename = callee_filename[0]
-            callee_key = callee_filename, callee
-            if callee_key not in itoposort and callee_key not in stackframe:
-                new_callees.append(callee_key)
-
-        # If any callee hasn't been seen, toposort all callees first
-        # and come back later
-        if new_callees:
-            stack.append(stackframe)
-            for callee in new_callees:
-                new_frame = list(stackframe)
-                new_frame.append(callee)
-                stack.append(new_frame)
+                callee = call_targets[call_offsets[node] + remain]
+            if visit_index[callee] < 0:
+                # Visit all of this callee's callees first
+                push(callee)
+            elif on_tarjan_stack[callee]:
+                lowlink[node] = min(lowlink[node], visit_index[callee])
+            continue
+
+        # All callees are visited
+        stack_nodes.pop()
+        stack_remain.pop()
+        toposort.append(node)
+        if stack_nodes:
+            caller = stack_nodes[-1]
+            lowlink[caller] = min(lowlink[caller], lowlink[node])
+        if lowlink[node] < visit_index[node]: continue
+
+        # This node is the first visited in a component
+        component = []
+        while not component or component[-1] != node:
+            component.append(tarjan_stack.pop())
+            on_tarjan_stack[component[-1]] = 0
+        component.reverse()
+        if len(component) > 1 or node in graph.callees(node):
+            loops.append(component)
+    return toposort, loops
+
+def describe_loops(graph, loops):
+    """Explain loops found by postorder_callees().
+
+A loop containing a call is an error because the callee's variables
+would overlap the caller's.  A loop of only tail calls is a warning.
+
+Return a 2-tuple (errors, warnings), each a list of messages
+"""
+    errors, warnings = [], []
+    for component in loops:
+        members = set(component)
+        has_call = any(callee in members
+                       for node in component
+                       for callee in graph.callees(node))
+        msg = ", ".join("%s in %s" % (graph.keys[node][1], graph.keys[node][0])
+                        for node in component)
+        if has_call:
+            errors.append("recursion among %s" % msg)
         else:
-            itoposort[routine_key] = len(itoposort)
+            warnings.append("tailcall loop among %s" % msg)
+    return errors, warnings
 
-    toposort = [None] * len(itoposort)
-    for symbol, index in itoposort.items():
-        toposort[index] = symbol
-    return toposort, itoposort
+def changed_nodes(graph, old_graph, loops=()):
+    """Flag nodes whose variables or callees differ from an earlier graph.
 
-def allocate(files, exports, toposort):
+Nodes that are new or in a loop are always flagged.
+
+Return a bytearray with 1 for each changed node number
+"""
+    dirty = bytearray(len(graph.keys))
+    for node, key in enumerate(graph.keys):
+        old_node = old_graph.key_index.get(key)
+        dirty[node] = (
+            old_node is None
+            or graph.local_sizes[node] != old_graph.local_sizes[old_node]
+            or ([graph.keys[x] for x in graph.callees(node)]
+                != [old_graph.keys[x] for x in old_graph.callees(old_node)])
+            or ([graph.keys[x] for x in graph.tailcallees(node)]
+                != [old_graph.keys[x] for x in old_graph.tailcallees(old_node)])
+        )
+    for component in loops:
+        for node in component: dirty[node] = 1
+    return dirty
+
+def allocate(graph, toposort, loops=(), dirty=None, previous=None):
     """Allocate local variables per a topological sort.
 
-files -- {filename: module, ...} where
-    module.calls is {label, ...}
-    module.tailcalls is {label, ...}
-    module.locals_size is {label: [(name, size), ...], ...}
-exports -- {symbol: (filename, ...), ...}
-toposort -- [(filename, label), ...] with callees first
+graph -- a CallGraph
+toposort -- node numbers with callees first
+loops -- strongly connected components from postorder_callees()
+dirty, previous -- if not None, a changed_nodes() result and an
+    earlier allocation.  A node that isn't dirty and calls nothing
+    dirty keeps its earlier allocation; otherwise it and its callers
+    are allocated again.
+
+In a tailcall loop, the tail call that closes the loop is to a
+callee not yet allocated.  So once all members of a loop are
+allocated, each member's self_use_end becomes the largest among
+them, as a caller of any member may reach all of them.
 
 Return an allocation
 {(filename, label): (callee_use_end, self_use_end), ...}
+in toposort order
 """
-    func_allocation = {}
-    for caller_key in toposort:
-        filename, label = caller_key
-        module = files[filename]
-        caller_locals = module.locals_size.get(label, [])
-
-        # find module for each callee
-        callees = module.calls[label]
-        tailcallees = module.tailcalls[label]
-        callee_file = {}
-        for callee in chain(callees, tailcallees):
-            try:
-                x = exports[callee]
-            except KeyError:
-                callee_file[callee] = filename
-            else:
-                callee_file[callee] = x[0]
+    num_nodes = len(graph.keys)
+    call_offsets, call_targets = graph.call_offsets, graph.call_targets
+    tail_offsets, tail_targets = graph.tail_offsets, graph.tail_targets
+    allocated = bytearray(num_nodes)
+    callee_use_end = array('I', [0]) * num_nodes
+    self_use_end = array('I', [0]) * num_nodes
+    loop_of_root = {component[0]: component for component in loops}
+    if dirty is not None: dirty = bytearray(dirty)
+    for node in toposort:
+        if dirty is not None:
+            old_uses = previous.get(graph.keys[node])
+            if old_uses and not (
+                dirty[node]
+                or any(dirty[x] for x in graph.callees(node))
+                or any(dirty[x] for x in graph.tailcallees(node))
+            ):
+                callee_use_end[node], self_use_end[node] = old_uses
+                allocated[node] = 1
+                continue
+            dirty[node] = 1
 
         # Start caller's variables after the self_use_end of its callees
         # and after the callee_use_end of its tail callees
         callee_max = tailcallee_max = 0
-        for callee in callees:
-            callee_key = callee_file[callee], callee
-            callee_uses = func_allocation[callee_key]
-            callee_max = max(callee_uses[1], callee_max)
-        for callee in tailcallees:
-            callee_key = callee_file[callee], callee
-            try:
-                callee_uses = func_allocation[callee_key]
-            except KeyError:
-                print("warning: %s in %s tailcall loop to %s in %s"
-                      % (callee_key[1], callee_key[0], label, filename),
-                      file=sys.stderr)
-                continue
-            tailcallee_max = max(callee_uses[1], tailcallee_max)
-
-        self_total = sum(row[1] for row in caller_locals)
-        self_end = max(tailcallee_max, self_total + callee_max)
-        func_allocation[caller_key] = callee_max, self_end
-    return func_allocation
+        for i in range(call_offsets[node], call_offsets[node + 1]):
+            callee = call_targets[i]
+            if allocated[callee]:
+                callee_max = max(self_use_end[callee], callee_max)
+        for i in range(tail_offsets[node], tail_offsets[node + 1]):
+            callee = tail_targets[i]
+            if allocated[callee]:
+                tailcallee_max = max(self_use_end[callee], tailcallee_max)
+
+        callee_use_end[node] = callee_max
+        self_use_end[node] = max(tailcallee_max,
+                                 graph.local_sizes[node] + callee_max)
+        allocated[node] = 1
+
+        # A loop's root comes last in the toposort among its members
+        component = loop_of_root.get(node)
+        if component:
+            loop_end = max(self_use_end[member] for member in component)
+            for member in component: self_use_end[member] = loop_end
+    return {graph.keys[node]: (callee_use_end[node], self_use_end[node])
+            for node in toposort}
 
 def format_allocation(files, allocation):
     """Format an allocation as RGBASM source code.
@@ -640,14 +963,36 @@ def parse_argv(argv):
                    help="print more debugging information")
     p.add_argument("-o", "--output", default="-",
                    help="write allocation to this file instead of standard output")
-    return p.parse_args(argv[1:])
-
-def main(argv=None):
-    args = parse_argv(argv or sys.argv)
-    result = load_files(args.sourcefile, verbose=args.verbose)
-    files, all_errors, all_warnings = result
+    p.add_argument("--cache",
+                   help="save parse results in this file and reparse only "
+                   "source files that changed since the last run")
+    p.add_argument("-j", "--jobs", type=int, default=1,
+                   help="number of worker processes for parsing")
+    p.add_argument("--watch", action="store_true",
+                   help="keep running, and rewrite the output when "
+                   "any source file changes and the allocation changes")
+    p.add_argument("--interval", type=float, default=0.5,
+                   help="seconds between checks for changes in --watch "
+                   "mode (default: 0.5)")
+    args = p.parse_args(argv[1:])
+    if args.watch and args.output == '-':
+        p.error("--watch requires -o")
+    return args
+
+def allocate_files(args, files, all_errors, all_warnings, previous=None):
+    """Sort parsed files' call graph and allocate variables.
+
+args -- parse_argv() result
+files, all_errors, all_warnings -- load_files() result
+previous -- (graph, allocation) from an earlier call, whose
+    allocations can be reused for functions that haven't changed
+
+Print diagnostics to stderr.
+Return (graph, allocation, allocation as RGBASM source), or None if
+there were errors.
+"""
     exports, errors = get_exports(files)
-    all_errors.extend(errors)
+    all_errors = all_errors + errors
     if all_errors:
         print("\n".join(
             "%s:%d: error: %s" % row for row in all_errors
@@ -657,15 +1002,109 @@ def main(argv=None):
             "%s:%d: warning: %s" % row for row in all_warnings
         ), file=sys.stderr)
     if all_errors:
-        exit(1)
-    toposort, itoposort = postorder_callees(files, exports)
+        return None
+    graph = build_call_graph(files, exports)
+    start_label = "$0100"
+    toposort, loops = postorder_callees(graph, (exports[start_label][0], start_label))
+    loop_errors, loop_warnings = describe_loops(graph, loops)
+    for msg in loop_warnings:
+        print("savescan.py: warning: %s" % msg, file=sys.stderr)
+    for msg in loop_errors:
+        print("savescan.py: error: %s" % msg, file=sys.stderr)
+    if loop_errors:
+        return None
     if args.verbose:
         print("savescan.py: topological sort of reachable subroutines from inner to outer", file=sys.stderr)
         print("\n".join(
-            "    %s in %s" % (subname, filename) for filename, subname in toposort
+            "    %s in %s" % graph.keys[node][::-1] for node in toposort
         ), file=sys.stderr)
-    allocation = allocate(files, exports, toposort)
-    tallocation = format_allocation(files, allocation)
+    if previous:
+        old_graph, old_allocation = previous
+        dirty = changed_nodes(graph, old_graph, loops)
+        allocation = allocate(graph, toposort, loops, dirty, old_allocation)
+    else:
+        allocation = allocate(graph, toposort, loops)
+    return graph, allocation, format_allocation(files, allocation)
+
+def write_if_changed(filename, text):
+    """Replace a file's contents unless it already contains text.
+
+Leaving an unchanged file alone keeps its modification time, so that
+make won't rebuild everything that depends on it.
+
+Return True if the file was written.
+"""
+    try:
+        with open(filename, "r") as infp:
+            if infp.read() == text: return False
+    except OSError:
+        pass
+    folder = os.path.dirname(filename) or "."
+    fd, tmpname = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    with os.fdopen(fd, "w") as outfp:
+        outfp.write(text)
+    os.replace(tmpname, filename)
+    return True
+
+def source_stamps(filenames):
+    """Return the modification time and size of each file, or None if missing."""
+    stamps = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append((st.st_mtime_ns, st.st_size))
+    return stamps
+
+def watch(args):
+    """Rewrite the output whenever a source file changes, until interrupted.
+
+Polls source files' modification times every args.interval seconds.
+Only changed files are parsed again, and only functions whose
+callees changed are allocated again.  The output is rewritten only
+if its contents change.
+"""
+    cache = ParseCache(args.cache)
+    stamps, previous = None, None
+    while True:
+        new_stamps = source_stamps(args.sourcefile)
+        if new_stamps != stamps:
+            stamps = new_stamps
+            try:
+                result = load_files(args.sourcefile, verbose=args.verbose,
+                                    cache=cache, jobs=args.jobs)
+            except OSError as e:
+                print("savescan.py: %s" % e, file=sys.stderr)
+                result = None
+            if result:
+                cache.save()
+                result = allocate_files(args, *result, previous=previous)
+            if result:
+                previous = result[:2]
+                if write_if_changed(args.output, result[2]):
+                    print("savescan.py: wrote %s" % args.output,
+                          file=sys.stderr)
+        time.sleep(args.interval)
+
+def main(argv=None):
+    args = parse_argv(argv or sys.argv)
+    if args.watch:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    cache = ParseCache(args.cache) if args.cache else None
+    result = load_files(args.sourcefile, verbose=args.verbose, cache=cache,
+                        jobs=args.jobs)
+    if cache: cache.save()
+    result = allocate_files(args, *result)
+    if not result:
+        exit(1)
+    tallocation = result[2]
     if args.output == '-':
         sys.stdout.write(tallocation)
     else:
@@ -20,8 +20,11 @@ freely, subject to the following restrictions:
    misrepresented as being the original software.
 3. This notice may not be removed or altered from any source distribution.
 """
+import os
 import sys
 import argparse
+import mmap
+from array import array
 
 def parse_argv(argv):
     parser = argparse.ArgumentParser()
@@ -32,9 +35,44 @@ def parse_argv(argv):
                         help="size of each tile (NES, GB: 16; SMS, MD, SNES: 32)")
     parser.add_argument("--map-add", type=int, default=0,
                         help="add this to all map entries")
+    parser.add_argument("--map-bits", type=int, choices=(8, 16), default=8,
+                        help="size of each map entry in bits; "
+                        "16-bit entries are little-endian (default: 8)")
+    parser.add_argument("--bank-file", metavar="ATTRFILE",
+                        help="split tiles into banks of 256 and write "
+                        "each map entry's bank number to ATTRFILE")
+    parser.add_argument("--bank-shift", type=int, default=3,
+                        help="shift bank numbers in ATTRFILE left this "
+                        "many bits (default: 3 for Game Boy Color)")
+    parser.add_argument("--max-banks", type=int, default=2,
+                        help="fail if tiles need more than this many banks "
+                        "(default: 2 for Game Boy Color VRAM)")
+    parser.add_argument("--mmap", action="store_true",
+                        help="map INFILE into memory instead of reading it")
     args = parser.parse_args(argv[1:])
+    if not 0 <= args.bank_shift <= 7:
+        parser.error("bank shift must be 0 to 7")
+    if not 1 <= args.max_banks <= 256 >> args.bank_shift:
+        parser.error("max banks must be 1 to %d with bank shift %d"
+                     % (256 >> args.bank_shift, args.bank_shift))
     return args
 
+def uniq_into(it, tilemap):
+    """Find unique items in an iterable, appending each one's index to tilemap.
+
+Return (uniques, tilemap).  A dict from each unique item to its
+index keeps lookups constant time per item.
+"""
+    tiles = []
+    tile2id = {}
+    for tile in it:
+        tileid = tile2id.get(tile)
+        if tileid is None:
+            tileid = tile2id[tile] = len(tiles)
+            tiles.append(tile)
+        tilemap.append(tileid)
+    return tiles, tilemap
+
 def uniq(it):
     """Find unique items in an iterable and return lists (uniques, order).
 
@@ -43,33 +81,92 @@ Items in it hashable.
 uniques appear in the same order as their first appearances in it:
 order[0] == 0 and order[x] <= max(order[:x]) + 1
 """
-    tiles = []
-    tile2id = {}
-    tilemap = []
-    for tile in it:
-        if tile not in tiles:
-            tile2id[tile] = len(tiles)
-            tiles.append(tile)
-        tilemap.append(tile2id[tile])
-    return tiles, tilemap
+    return uniq_into(it, [])
+
+def uniq_array(it):
+    """Find unique items in an iterable and return (uniques, order).
+
+Same as uniq() except order is an array('H') of 16-bit unsigned
+indices, using 2 bytes per entry instead of a Python int.
+Raises OverflowError past 65536 unique items.
+"""
+    return uniq_into(it, array('H'))
+
+def iter_blocks(data, block_size):
+    """Split a buffer into fixed-size blocks without copying it.
+
+Yield read-only memoryview slices, which hash and compare equal
+like the bytes they view.  The last block may be short.
+"""
+    view = memoryview(data)
+    return (view[i:i + block_size] for i in range(0, len(view), block_size))
+
+def load_input(filename, use_mmap=False):
+    """Read a file, or map it read-only into memory if use_mmap."""
+    with open(filename, "rb") as infp:
+        # mmap refuses empty files
+        if use_mmap and os.fstat(infp.fileno()).st_size:
+            return mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+        return infp.read()
+
+def write_tiles(filename, tiles, bank_size=256):
+    """Write unique tiles to a file.
+
+If filename contains %d, write each bank of bank_size tiles to a
+separate file named filename % bank number.
+"""
+    if "%d" not in filename:
+        with open(filename, "wb") as outfp:
+            outfp.writelines(tiles)
+        return
+    for bank in range(0, max(len(tiles), 1), bank_size):
+        with open(filename % (bank // bank_size), "wb") as outfp:
+            outfp.writelines(tiles[bank:bank + bank_size])
+
+def format_tilemap(tilemap, map_add=0, map_bits=8, banked=False):
+    """Convert tile numbers to map entries.
+
+Return (map bytes, bank numbers), where bank numbers is None unless
+banked.  If banked, each entry counts from the start of its bank of
+256 tiles.
+"""
+    banks = None
+    if banked:
+        banks = bytes(b >> 8 for b in tilemap)
+        tilemap = (b & 0xFF for b in tilemap)
+    if map_bits == 8:
+        return bytes((map_add + b) & 0xFF for b in tilemap), banks
+    tilemap = array('H', ((map_add + b) & 0xFFFF for b in tilemap))
+    if sys.byteorder != 'little': tilemap.byteswap()
+    return tilemap.tobytes(), banks
 
 def main(argv=None):
     args = parse_argv(argv or sys.argv)
-    with open(args.INFILE, "rb") as infp:
-        data = infp.read()
-    block_size = args.block_size
-    data = [data[i:i + block_size] for i in range(0, len(data), block_size)]
-    tiles, tilemap = uniq(data)
-    if len(tiles) > 256:
-        print("%s: too many tiles (%d)"
-              % (args.INFILE, len(tiles)), file=sys.stderr)
+    data = load_input(args.INFILE, args.mmap)
+    banked = args.bank_file is not None
+    if banked:
+        max_tiles = 256 * args.max_banks
+    else:
+        max_tiles = 1 << args.map_bits
+    try:
+        tiles, tilemap = uniq_array(iter_blocks(data, args.block_size))
+    except OverflowError:
+        ntiles = "more than 65536"
+    else:
+        ntiles = len(tiles)
+    if isinstance(ntiles, str) or ntiles > max_tiles:
+        print("%s: too many tiles (%s > %d)"
+              % (args.INFILE, ntiles, max_tiles), file=sys.stderr)
         sys.exit(1)
-    map_add = args.map_add
-    tilemap = bytes((map_add + b) & 0xFF for b in tilemap)
-    with open(args.TILEFILE, "wb") as outfp:
-        outfp.writelines(tiles)
+    tilemap, banks = format_tilemap(tilemap, args.map_add,
+                                    args.map_bits, banked)
+    write_tiles(args.TILEFILE, tiles)
     with open(args.MAPFILE, "wb") as outfp:
         outfp.write(tilemap)
+    if banked:
+        shift = args.bank_shift
+        with open(args.bank_file, "wb") as outfp:
+            outfp.write(bytes(b << shift for b in banks))
 
 if __name__=='__main__':
     main()
@@ -19,60 +19,372 @@ freely, subject to the following restrictions:
    misrepresented as being the original software.
 3. This notice may not be removed or altered from any source distribution.
 """
+import os
+import sys
+import argparse
+from collections import namedtuple, OrderedDict
 from PIL import Image
+import chrcache
+
+VWFont = namedtuple("VWFont", ["name", "tileHt", "widths", "tiledata"])
 
 def rgbasm_bytearray(s):
     s = ['  db ' + ','.join("%3d" % ch for ch in s[i:i + 16])
          for i in range(0, len(s), 16)]
     return '\n'.join(s)
 
+def wla_bytearray(s):
+    s = ['  .db ' + ','.join("%3d" % ch for ch in s[i:i + 16])
+         for i in range(0, len(s), 16)]
+    return '\n'.join(s)
+
 def vwfcvt(filename, tileHt=8):
     im = Image.open(filename)
-    pixels = im.load()
+    cache = chrcache.get_default()
+    if cache:
+        key = chrcache.make_key("vwfcvt", chrcache.source_digest(__file__),
+                                chrcache.image_digest(im), tileHt)
+        data = cache.get(key)
+        if data is not None:
+            nglyphs = len(data) // (tileHt + 1)
+            return bytearray(data[:nglyphs]), bytearray(data[nglyphs:])
+    if im.mode not in ('P', 'L'):
+        im = im.convert('L')
     (w, h) = im.size
     (xparentColor, sepColor) = im.getextrema()
+    glyphcols, glyphrows = -(-w // 8), -(-h // tileHt)
+
+    # Pad to whole glyphs with transparent pixels
+    data = im.tobytes()
+    padw, padh = glyphcols * 8, glyphrows * tileHt
+    if (padw, padh) != (w, h):
+        padded = bytearray([xparentColor]) * (padw * padh)
+        for y in range(h):
+            padded[y * padw:y * padw + w] = data[y * w:y * w + w]
+        data = bytes(padded)
+
+    # Pack each 8-pixel sliver into a byte, one pixel column at a
+    # time for the whole sheet.  Opaque pixels are neither the
+    # transparent nor the separator color.
+    slivers, seps = 0, 0
+    for x in range(8):
+        opaquetable = bytes(0 if v in (xparentColor, sepColor) else 0x80 >> x
+                            for v in range(256))
+        septable = bytes(0x80 >> x if v == sepColor else 0
+                         for v in range(256))
+        column = data[x::8]
+        slivers |= int.from_bytes(column.translate(opaquetable), "big")
+        seps |= int.from_bytes(column.translate(septable), "big")
+    nslivers = len(data) // 8
+    slivers = slivers.to_bytes(nslivers, "big")
+    seps = seps.to_bytes(nslivers, "big")
+
+    # A glyph's width is the position of the first separator pixel
+    # on its top row, or 8 if none
+    firstbit = bytes([8]) + bytes(8 - v.bit_length() for v in range(1, 256))
     widths = bytearray()
-    tiledata = bytearray()
-    for yt in range(0, h, tileHt):
-        for xt in range(0, w, 8):
-            # step 1: find the glyph width
-            tilew = 8
-            for x in range(8):
-                if pixels[x + xt, yt] == sepColor:
-                    tilew = x
-                    break
-            # step 2: encode the pixels
-            widths.append(tilew)
-            for y in range(tileHt):
-                rowdata = 0
-                for x in range(8):
-                    pxhere = pixels[x + xt, y + yt]
-                    pxhere = 0 if pxhere in (xparentColor, sepColor) else 1
-                    rowdata = (rowdata << 1) | pxhere
-                tiledata.append(rowdata)
+    for yt in range(0, padh, tileHt):
+        widths.extend(seps[yt * glyphcols:(yt + 1) * glyphcols]
+                      .translate(firstbit))
+
+    # Reorder slivers from raster order to glyph order
+    tiledata = bytearray(nslivers)
+    for xt in range(glyphcols):
+        for y in range(tileHt):
+            tiledata[xt * tileHt + y::glyphcols * tileHt] = (
+                slivers[y * glyphcols + xt::tileHt * glyphcols]
+            )
+    if cache:
+        cache.put(key, bytes(widths + tiledata))
     return (widths, tiledata)
 
-def main(argv=None):
-    import sys
-    if argv is None:
-        argv = sys.argv
-    if len(argv) > 1 and argv[1] == '--help':
-        print("usage: %s font.png font.s" % argv[0])
-        return
-    if len(argv) != 3:
-        print("wrong number of options; try %s --help" % argv[0], file=sys.stderr)
-        sys.exit(1)
-        
-    (widths, tiledata) = vwfcvt(argv[1])
+def align_log2(tileHt):
+    """Return the log base 2 of the alignment for glyphs of this height."""
+    return max(tileHt - 1, 0).bit_length()
+
+def dedup_glyphs(font):
+    """Find identical glyph bitmaps.
+
+Return (index, uniques): index is one byte per glyph giving its
+position in uniques, a list of distinct glyph bitmaps.
+"""
+    ht = font.tileHt
+    glyphs = [bytes(font.tiledata[i:i + ht])
+              for i in range(0, len(font.tiledata), ht)]
+    uniques, glyph2id, index = [], {}, bytearray()
+    for glyph in glyphs:
+        if glyph not in glyph2id:
+            glyph2id[glyph] = len(uniques)
+            uniques.append(glyph)
+        index.append(glyph2id[glyph])
+    if len(uniques) > 256:
+        raise ValueError("%s: too many unique glyphs (%d > 256)"
+                         % (font.name, len(uniques)))
+    return bytes(index), uniques
+
+def glyph_columns(glyph):
+    """Transpose a glyph's rows into columns, dropping blank columns at right.
+
+Each column is one byte per 8 rows, with the top row in bit 7.
+"""
+    ht = len(glyph)
+    cols = []
+    for x in range(8):
+        for y0 in range(0, ht, 8):
+            colbyte = 0
+            for y in range(y0, min(y0 + 8, ht)):
+                colbyte |= ((glyph[y] >> (7 - x)) & 1) << (7 - (y - y0))
+            cols.append(colbyte)
+    colsize = -(-ht // 8)
+    while cols and not any(cols[-colsize:]):
+        del cols[-colsize:]
+    return bytes(cols)
+
+def font_blocks(font, dedup=False, columns=False):
+    """List the (label suffix, data) blocks to emit for a font.
+
+Plain: ChrData (glyph rows, tileHt bytes each) and ChrWidths.
+dedup -- store each distinct glyph once in ChrData, preceded by
+    ChrIndex, one byte per glyph giving its unique glyph number
+columns -- instead of ChrData, store each distinct glyph's used
+    columns in ChrColumns, with 16-bit little-endian ChrOffsets
+    into it for each unique glyph and one past the end
+"""
+    if not (dedup or columns):
+        return [("ChrData", bytes(font.tiledata)),
+                ("ChrWidths", bytes(font.widths))]
+    index, uniques = dedup_glyphs(font)
+    blocks = [("ChrIndex", index)]
+    if columns:
+        offsets, coldata = bytearray(), bytearray()
+        for glyph in uniques:
+            offsets.extend(len(coldata).to_bytes(2, "little"))
+            coldata.extend(glyph_columns(glyph))
+        offsets.extend(len(coldata).to_bytes(2, "little"))
+        blocks.extend([("ChrOffsets", bytes(offsets)),
+                       ("ChrColumns", bytes(coldata))])
+    else:
+        blocks.append(("ChrData", b"".join(uniques)))
+    blocks.append(("ChrWidths", bytes(font.widths)))
+    return blocks
+
+def report_savings(font, blocks, file=sys.stderr):
+    """Print how many bytes a font's blocks save over plain glyph rows."""
+    plain = len(font.tiledata) + len(font.widths)
+    packed = sum(len(data) for suffix, data in blocks)
+    nglyphs = len(font.widths)
+    nuniques = len(dedup_glyphs(font)[1])
+    print("%s: %d glyphs, %d unique; %d bytes instead of %d (saves %d)"
+          % (font.name, nglyphs, nuniques, packed, plain, plain - packed),
+          file=file)
+
+def format_rgbasm(fonts, blocks, binfiles=None):
+    """Format fonts as RGBASM source.
+
+blocks -- dict from font name to font_blocks() result
+binfiles -- if not None, a dict from font name to the
+    write_binaries() result to incbin instead of writing each byte
+    as text
+"""
+    out = ["; Generated by vwfbuild"]
+    for font in fonts:
+        aln = align_log2(font.tileHt)
+        out.append('section "%sChrData",ROM0,align[%d]  ; log2(glyph height) = %d'
+                   % (font.name, aln, aln))
+        for suffix, data in blocks[font.name]:
+            label = font.name + suffix
+            if not binfiles:
+                out.extend(["%s::" % label, rgbasm_bytearray(data)])
+                continue
+            binname, pairs = binfiles[font.name][suffix]
+            if pairs is not None:
+                out.extend([
+                    "def %s_PB16_PACKET_PAIRS equ %d" % (label, pairs),
+                    " export %s_PB16_PACKET_PAIRS" % label,
+                ])
+                label += "PB16"
+            out.extend(["%s::" % label, '  incbin "%s"' % binname])
+    out.append('')
+    return out
+
+def format_wla(fonts, blocks, binfiles=None):
+    """Format fonts as WLA-DX source.
+
+blocks, binfiles -- as for format_rgbasm()
+"""
     out = ["; Generated by vwfbuild",
-           'section "vwfChrData",ROM0,align[3]  ; log2(glyph height) = 3',
-           'vwfChrData::',
-           rgbasm_bytearray(tiledata),
-           "vwfChrWidths::",
-           rgbasm_bytearray(widths),
-           '']
-    with open(argv[2], 'w') as outfp:
-        outfp.write('\n'.join(out))
+           '.include "src/sms.inc"']
+    for font in fonts:
+        out.append('.section "%sChrData" align %d  ; glyph height = %d'
+                   % (font.name, 1 << align_log2(font.tileHt), font.tileHt))
+        for suffix, data in blocks[font.name]:
+            label = font.name + suffix
+            if not binfiles:
+                out.extend(["%s:" % label, wla_bytearray(data)])
+                continue
+            binname, pairs = binfiles[font.name][suffix]
+            if pairs is not None:
+                out.append(".define %s_PB16_PACKET_PAIRS %d" % (label, pairs))
+                label += "PB16"
+            out.extend(["%s:" % label, '  .incbin "%s"' % binname])
+        out.append('.ends')
+    out.append('')
+    return out
+
+# Binary file extension for each block
+block_extensions = {
+    "ChrData": "glyphs",
+    "ChrWidths": "widths",
+    "ChrIndex": "index",
+    "ChrOffsets": "offsets",
+    "ChrColumns": "columns",
+}
+
+# Blocks of glyph pixels, which --pb16 compresses
+pb16_blocks = ("ChrData", "ChrColumns")
+
+def write_binaries(blocks, outfilename, usePB16=False):
+    """Write each font's blocks as binary files.
+
+Files are named after outfilename without its extension, then
+-NAME.glyphs (or .glyphs.pb16), -NAME.widths, and so on.  If usePB16,
+glyph data (ChrData or ChrColumns) is padded to a multiple of 16
+bytes and PB16 compressed, and the program must unpack it to RAM
+before use with pb16_unpack_block, which takes the number of
+16-byte pairs of packets in B.
+
+Return a dict from font name to a dict from label suffix to
+(filename, number of PB16 packet pairs or None).
+
+Raise ValueError if a block has more than 255 packet pairs.
+"""
+    stem = os.path.splitext(outfilename)[0].replace(os.sep, "/")
+    out = {}
+    for name, fontblocks in blocks.items():
+        out[name] = fontout = {}
+        for suffix, data in fontblocks:
+            binname = "%s-%s.%s" % (stem, name, block_extensions[suffix])
+            pairs = None
+            if usePB16 and suffix in pb16_blocks:
+                import pb16
+                binname += ".pb16"
+                pairs = -(-len(data) // 16)
+                if pairs > 255:
+                    raise ValueError("%s%s: %d PB16 packet pairs exceed 255"
+                                     % (name, suffix, pairs))
+                data = pb16.encode(data + bytes(pairs * 16 - len(data)))
+            with open(binname, "wb") as outfp:
+                outfp.write(data)
+            fontout[suffix] = binname, pairs
+    return out
+
+dialects = {
+    "rgbasm": format_rgbasm,
+    "wla": format_wla,
+}
+
+def parse_fontspec(spec):
+    """Parse [NAME=]IMAGE[:HEIGHT] into (name, filename, tileHt)."""
+    name, eq, filename = spec.partition("=")
+    if not eq:
+        name, filename = "vwf", spec
+    tileHt = 8
+    head, colon, tail = filename.rpartition(":")
+    if colon and tail.isdigit():
+        filename, tileHt = head, int(tail)
+    if tileHt <= 0:
+        raise ValueError("%s: glyph height must be positive" % spec)
+    return name, filename, tileHt
+
+helpepilog = """
+Each FONT is [NAME=]IMAGE.png[:HEIGHT].  NAME prefixes the labels
+NAMEChrData and NAMEChrWidths (default: vwf), and HEIGHT is the
+glyph height in pixels (default: 8).  If the last argument is not
+a .png file, it is an output file in the default dialect.
+Every output file gets all fonts.  With --binary, each output file
+instead includes binary files named after it, so assembly time does
+not grow with font size.
+"""
+
+def parse_argv(argv, default_dialect="rgbasm"):
+    p = argparse.ArgumentParser(
+        usage="%(prog)s [options] FONT [FONT ...] [OUTFILE]",
+        epilog=helpepilog
+    )
+    p.add_argument("files", nargs="+", metavar="FONT",
+                   help="font image to convert")
+    for dialect in sorted(dialects):
+        p.add_argument("--" + dialect, action="append", default=[],
+                       metavar="OUTFILE",
+                       help="write fonts as %s source" % dialect)
+    p.add_argument("--binary", action="store_true",
+                   help="write glyphs and widths to binary files "
+                   "included by each output file")
+    p.add_argument("--pb16", action="store_true",
+                   help="PB16 compress binary glyph data (implies --binary)")
+    p.add_argument("--dedup", action="store_true",
+                   help="store identical glyphs once, with an index table")
+    p.add_argument("--columns", action="store_true",
+                   help="store only each glyph's used columns "
+                   "(implies --dedup)")
+    p.add_argument("-v", "--verbose", action="store_true",
+                   help="report bytes saved by --dedup or --columns")
+    args = p.parse_args(argv[1:])
+    if args.pb16: args.binary = True
+
+    fontspecs = args.files
+    outputs = [(dialect, filename)
+               for dialect in sorted(dialects)
+               for filename in getattr(args, dialect)]
+    try:
+        fonts = [parse_fontspec(x) for x in fontspecs]
+    except ValueError as e:
+        p.error(str(e))
+    if len(fonts) > 1 and not fonts[-1][1].lower().endswith(".png"):
+        outputs.append((default_dialect, fontspecs[-1]))
+        del fonts[-1]
+    if not outputs:
+        p.error("no output files")
+    names = [name for name, filename, tileHt in fonts]
+    dups = sorted(set(name for name in names if names.count(name) > 1))
+    if dups:
+        p.error("duplicate font name %s; give each font NAME=IMAGE"
+                % ", ".join(dups))
+    args.fonts = fonts
+    args.outputs = outputs
+    return args
+
+def main(argv=None, default_dialect="rgbasm"):
+    args = parse_argv(argv or sys.argv, default_dialect)
+
+    # Decode each font once for all outputs
+    fonts = [
+        VWFont(name, tileHt, *vwfcvt(filename, tileHt))
+        for name, filename, tileHt in args.fonts
+    ]
+    try:
+        blocks = OrderedDict(
+            (font.name, font_blocks(font, args.dedup, args.columns))
+            for font in fonts
+        )
+    except ValueError as e:
+        print("vwfbuild: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    if args.verbose:
+        for font in fonts:
+            report_savings(font, blocks[font.name])
+
+    for dialect, filename in args.outputs:
+        binfiles = None
+        if args.binary:
+            try:
+                binfiles = write_binaries(blocks, filename, args.pb16)
+            except ValueError as e:
+                print("vwfbuild: %s" % e, file=sys.stderr)
+                sys.exit(1)
+        out = dialects[dialect](fonts, blocks, binfiles)
+        with open(filename, 'w') as outfp:
+            outfp.write('\n'.join(out))
 
 if __name__ == '__main__':
 ##    main(['vwfbuild', '../tilesets/vwf7.png', '../obj/gb/vwf7.s'])